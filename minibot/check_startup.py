@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Startup regression check for plexBot.py. Imports the CLI and the
+modules that import the shared logger and db in a fresh interpreter under
+`python -X importtime` and fails if a heavy dependency is loaded, the
+logger or db is created, or the imports take longer than the budget.
+
+    python3 check_startup.py [--budget-ms 150] [--runs 5]
+
+tests/test_startup.py runs the same checks under pytest.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+BUDGET_MS = 150
+
+_minibot_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Without a config.py, e.g. on a fresh checkout, fall back to the example
+_config_fallback = (
+    "import importlib.util, sys\n"
+    "spec = importlib.util.spec_from_file_location("
+    "'utilities.config', 'utilities/config_example.py')\n"
+    "sys.modules['utilities.config'] = importlib.util.module_from_spec(spec)\n"
+    "spec.loader.exec_module(sys.modules['utilities.config'])\n")
+
+IMPORTS = ("import plexBot\n"
+           "from utilities import batch, client, daemon, filesyncer, "
+           "plexMatch, resolver\n")
+
+CHECK = IMPORTS + (
+    "import sys\n"
+    "import utilities\n"
+    "heavy = [m for m in ('plexapi', 'pysftp', 'paramiko', 'flask') "
+    "if m in sys.modules]\n"
+    "created = [n for n in ('logger', 'db') "
+    "if object.__getattribute__(getattr(utilities, n), '_lazy_target') "
+    "is not None]\n"
+    "print(','.join(heavy) or '-', ','.join(created) or '-')\n")
+
+_importtime_line = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(.*)")
+
+
+def _run(code, *flags):
+    if not os.path.exists(
+            os.path.join(_minibot_dir, "utilities", "config.py")):
+        code = _config_fallback + code
+    return subprocess.run([sys.executable, *flags, "-c", code],
+                          cwd=_minibot_dir, capture_output=True, text=True,
+                          check=True)
+
+
+def startup_state():
+    """Import everything in a fresh interpreter.
+    Returns:
+        - tuple(list(heavy modules loaded), list(lazy objects created))
+    """
+    heavy, created = _run(CHECK).stdout.split()
+
+    return [m for m in heavy.split(",") if m != "-"], \
+        [n for n in created.split(",") if n != "-"]
+
+
+def import_time_us():
+    """Returns the cumulative import time of IMPORTS in microseconds and
+    the five slowest top level imports.
+    """
+    stderr = _run(IMPORTS, "-X", "importtime").stderr
+    top_level = []
+    for line in stderr.splitlines():
+        match = _importtime_line.match(line)
+        if match and not match.group(3).startswith("  "):
+            top_level.append((int(match.group(2)), match.group(3).strip()))
+
+    return sum(us for us, _ in top_level), sorted(top_level)[-5:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    heavy, created = startup_state()
+    failures = []
+    if heavy:
+        failures.append(f"heavy modules imported at startup: {heavy}")
+    if created:
+        failures.append(f"created at import: {created}")
+
+    runs = [import_time_us() for _ in range(max(1, args.runs))]
+    best_us, slowest = min(runs, key=lambda run: run[0])
+    print(f"Startup imports: best of {len(runs)} {best_us / 1000:.1f}ms "
+          f"(budget {args.budget_ms:.0f}ms)")
+    for us, name in reversed(slowest):
+        print(f"  {us / 1000:7.1f}ms {name}")
+    if best_us / 1000 > args.budget_ms:
+        failures.append(f"imports took {best_us / 1000:.1f}ms")
+
+    for failure in failures:
+        print(f" * FAIL: {failure}")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,16 +18,41 @@ def parse_arguments():
         help="Enable dryrun mode. Message will not be sent.")
     parser.add_argument(
         "-i", "--guid", dest="imdb_guid", metavar="<IMDb guid>",
-        required=False, action="store", default=None,
-        help="Find movie by IMDb guid.")
+        required=False, action="append", default=None,
+        help="Find movie by IMDb guid. Repeat to send many, paired by "
+             "position with -p.")
     parser.add_argument(
         "-p", "--path", dest="path", metavar="<file path>",
-        required=False, action="store",
-        help="Path to file.")
+        required=False, action="append", default=None,
+        help="Path to file. Repeat to send many.")
+    parser.add_argument(
+        "-b", "--batch", dest="batch", metavar="<file>",
+        required=False, action="store", default=None,
+        help="Read guid/path pairs as NDJSON, one object per line, from a "
+             "file or - for stdin, e.g. {\"guid\": ..., \"path\": ...}")
+    parser.add_argument(
+        "-j", "--concurrency", dest="concurrency", metavar="<n>",
+        required=False, action="store", type=int, default=None,
+        help="Requests in flight at once for batch input.")
     parser.add_argument(
         "-s", "--sync", dest="sync_queue",
         required=False, action="store_true",
         help="Start file sync transfer queue")
+    parser.add_argument(
+        "--daemon", dest="daemon",
+        required=False, action="store_true",
+        help="Run the notification daemon. -i requests are forwarded to it "
+             "while it is running.")
+    parser.add_argument(
+        "--inprocess", dest="inprocess",
+        required=False, action="store_true",
+        help="Send -i notifications in-process, even if the daemon is "
+             "running.")
+    parser.add_argument(
+        "--flush", dest="flush_spool",
+        required=False, action="store_true",
+        help="Send every sync request waiting in the local spool, "
+             "including those waiting to be retried.")
     parser.add_argument(
         "--test", dest="test",
         required=False, action="store_true",
@@ -44,21 +69,48 @@ def parse_arguments():
 def main():
     args, parser = parse_arguments()
 
-    if args.sync_queue:
+    guids = args.imdb_guid or []
+    paths = args.path or []
+    batch_input = args.batch or len(guids) > 1 or len(paths) > 1
+    if not batch_input:
+        args.imdb_guid = guids[0] if guids else None
+        args.path = paths[0] if paths else None
+
+    if args.daemon:
+        _codepath = "notification daemon"
+        logger.info("Starting notification daemon")
+        from utilities import daemon
+
+        daemon.run_daemon()
+
+    elif args.sync_queue:
         _codepath = "syncer"
         logger.info("Starting file syncer")
         from utilities import filesyncer
 
         filesyncer.run_file_syncer()
 
+    elif args.flush_spool:
+        _codepath = "flush spool"
+        from utilities import client
+        client.flush_spool(force=True)
+
+    elif batch_input:
+        _codepath = "batch"
+        from utilities import batch
+
+        try:
+            batch.run(args)
+        except ValueError as e:
+            logger.error(str(e))
+
     elif args.path and args.imdb_guid:
         """Requiring imdb_guid for now until I can disambiguate movies vs 
         other media, e.g. music, tv shows, etc..."""
         _codepath = "sync request"
         logger.info(f"Sending sync request: {args.imdb_guid} - {args.path}")
         from utilities import client
-        client.post_new_movie_to_syncer(
-                path=args.path, imdb_guid=args.imdb_guid)
+        client.submit_new_movie(path=args.path, imdb_guid=args.imdb_guid)
 
     elif args.path:
         """Best-effort attempt to parse the title and year from the filepath 
@@ -67,7 +119,7 @@ def main():
         if args.pathonly:
             logger.info(f"Sending path only sync request: {args.path}")
             from utilities import client
-            client.post_new_movie_to_syncer(path=args.path)
+            client.submit_new_movie(path=args.path)
         else:
             logger.info(
                 f"Sync request failed. IMDb guid required: {args.path}")
@@ -75,8 +127,18 @@ def main():
     elif args.imdb_guid:
         _codepath = "notification sender"
         logger.info(f"Sending new movie notification: {args.imdb_guid}")
-        from utilities import plexutils
-        plexutils.send_new_movie_slack_notification(args)
+        from utilities import daemon
+        try:
+            forwarded = not args.inprocess and daemon.forward_notification(
+                args.imdb_guid, debug=args.debug, dryrun=args.dryrun)
+        except daemon.DaemonException as e:
+            # The daemon may already have queued it, don't send it twice
+            logger.error(f"{str(e)}. Notification may not have been sent: "
+                         f"{args.imdb_guid}")
+            forwarded = True
+        if not forwarded:
+            from utilities import plexutils
+            plexutils.send_new_movie_slack_notification(args)
 
     elif args.test:
         _codepath = "endpoint test"
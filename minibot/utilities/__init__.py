@@ -1,13 +1,73 @@
 #!/usr/bin/env python3
+"""The shared logger and transfer database are created on first use."""
 import os.path
+import threading
 
 from utilities import config
-from utilities import dbutils
-from utilities import utils
-from utilities.utils import Logger
+from utilities import config_example
+
+# Settings added since config.py was copied from config_example.py fall
+# back to the example's values
+for _name, _value in vars(config_example).items():
+    if not _name.startswith("_") and not hasattr(config, _name):
+        setattr(config, _name, _value)
 
 logfile = os.path.abspath(
     os.path.join(os.path.dirname(os.path.dirname(__file__)), config.LOG_FILE))
-logger = Logger(file_path=logfile, stdout=True)
 
-db = dbutils.FileTransferDB()
+
+class _Lazy(object):
+    """Stands in for the object built by factory, building it the first
+    time one of its attributes is used. Modules can import the proxy at the
+    top as before without paying for it at import.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_lazy_factory", factory)
+        object.__setattr__(self, "_lazy_target", None)
+        object.__setattr__(self, "_lazy_lock", threading.Lock())
+
+    def _resolve(self):
+        target = object.__getattribute__(self, "_lazy_target")
+        if target is None:
+            with object.__getattribute__(self, "_lazy_lock"):
+                target = object.__getattribute__(self, "_lazy_target")
+                if target is None:
+                    target = object.__getattribute__(self, "_lazy_factory")()
+                    object.__setattr__(self, "_lazy_target", target)
+
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __repr__(self):
+        target = object.__getattribute__(self, "_lazy_target")
+        if target is None:
+            return "<lazy, not created>"
+
+        return repr(target)
+
+
+def _make_logger():
+    from utilities.utils import Logger
+
+    return Logger(file_path=logfile, stdout=True, level=config.LOG_LEVEL,
+                  buffered=config.LOG_BUFFERED,
+                  max_bytes=config.LOG_MAX_BYTES,
+                  backup_count=config.LOG_BACKUP_COUNT,
+                  rotate_interval=config.LOG_ROTATE_INTERVAL,
+                  log_format=config.LOG_FORMAT)
+
+
+def _make_db():
+    from utilities import dbutils
+
+    return dbutils.FileTransferDB()
+
+
+logger = _Lazy(_make_logger)
+db = _Lazy(_make_db)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Batch input for plexBot.py: guid/path pairs from repeated -i/-p flags
+or from an NDJSON --batch file, sent through a bounded thread pool.
+"""
+import itertools
+import json
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from utilities import config
+from utilities import logger
+from utilities import utils
+
+SYNC = "sync requests"
+PATH_SYNC = "path-only sync requests"
+NOTIFY = "notifications"
+
+Result = namedtuple("Result", ("kind", "guid", "path", "ok", "status",
+                               "seconds"))
+
+
+def read_items(source):
+    """Yield {"guid", "path"} dicts from an NDJSON file, or stdin for "-".
+    Blank lines and lines starting with # are skipped.
+    """
+    stream = sys.stdin if source == "-" else open(source)
+    try:
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None
+            if not isinstance(item, dict):
+                logger.error(f"Skipping invalid line {line_number}: {line}")
+                continue
+
+            yield {"guid": item.get("guid") or item.get("imdb_guid"),
+                   "path": item.get("path")}
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def items_from_args(guids, paths):
+    """Pair repeated -i and -p flags by position. If only one of them is
+    given, each value is an item on its own.
+    """
+    guids = guids or []
+    paths = paths or []
+    if guids and paths and len(guids) != len(paths):
+        raise ValueError(f"Got {len(guids)} guids and {len(paths)} paths, "
+                         f"pass one guid per path")
+
+    return [{"guid": guid, "path": path} for guid, path
+            in itertools.zip_longest(guids, paths)]
+
+
+class BatchRunner(object):
+    """Sends every item through a shared, bounded pool of worker threads.
+    Optional kwargs:
+        - concurrency (int): requests in flight at once
+        - pathonly (bool): allow sync requests without a guid
+        - debug, dryrun (bool): as for single notifications
+        - inprocess (bool): send notifications here even if the
+          notification daemon is running
+    """
+
+    def __init__(self, concurrency=None, pathonly=False, debug=False,
+                 dryrun=False, inprocess=False):
+        self.concurrency = max(1, concurrency or config.CLI_CONCURRENCY)
+        self.pathonly = pathonly
+        self.debug = debug
+        self.dryrun = dryrun
+        self.inprocess = inprocess
+        self.results = []
+        self.elapsed = None
+        self._use_daemon = False
+        self._spooled = False
+        self._sessions = []
+        self._local = threading.local()
+        self._results_lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(self.concurrency * 2)
+
+    def _session(self):
+        if getattr(self._local, "session", None) is None:
+            import requests
+            self._local.session = requests.Session()
+            self._sessions.append(self._local.session)
+
+        return self._local.session
+
+    def _notifier(self):
+        if getattr(self._local, "notifier", None) is None:
+            from utilities import plexutils
+            self._local.notifier = plexutils.MovieNotification(
+                session=self._session(),
+                omdb_cache_ttl=config.OMDB_CACHE_TTL,
+                auth_type=config.PLEX_AUTH_TYPE)
+
+        return self._local.notifier
+
+    def _timed(self, kind, item, func):
+        start = time.perf_counter()
+        try:
+            ok, status = func(item)
+        except Exception as e:
+            ok, status = False, f"{type(e).__name__}: {str(e)}"
+        seconds = time.perf_counter() - start
+        if not ok:
+            logger.error(f"Failed: {item['guid'] or item['path']} - {status}")
+
+        return [Result(kind, item['guid'], item['path'], ok, status,
+                       seconds)]
+
+    def _notify(self, item):
+        from utilities import daemon
+        from utilities import plexutils
+
+        if self._use_daemon:
+            request_id = daemon.forward_notification(
+                item['guid'], debug=self.debug, dryrun=self.dryrun)
+            if request_id:
+                return True, f"queued by daemon: {request_id}"
+
+        args = SimpleNamespace(imdb_guid=item['guid'], debug=self.debug,
+                               dryrun=self.dryrun)
+        notifier = self._notifier()
+        try:
+            plexutils.send_new_movie_slack_notification(
+                args, notifier=notifier, session=self._session())
+        except Exception:
+            notifier.reset()
+            raise
+
+        return True, "sent"
+
+    def _sync_path(self, item):
+        from utilities import client
+
+        r = client.post_new_movie_to_syncer(
+            path=item['path'], session=self._session())
+        if r is None and self._spool([item]):
+            return True, "spooled for retry"
+        if r is None:
+            return False, "no response"
+
+        return r.status_code in (200, 202, 208), \
+            f"{r.status_code} {r.reason}"
+
+    def _spool(self, movies):
+        """Keep requests the listener did not answer in the client spool,
+        if it is enabled. They are flushed in the background once the run
+        is over.
+        Returns:
+            - bool: whether they were spooled
+        """
+        from utilities import client
+
+        if not movies or not config.CLIENT_SPOOL:
+            return False
+        try:
+            client.spool_new_movies(movies)
+        except Exception as e:
+            logger.error(f"Failed to spool {len(movies)} requests: {str(e)}")
+            return False
+        self._spooled = True
+
+        return True
+
+    @staticmethod
+    def _flush_spool():
+        from utilities import client
+
+        try:
+            client.flush_spool_detached()
+        except OSError as e:
+            logger.warning(f"Could not start spool flush, requests stay "
+                           f"spooled until the next one: {str(e)}")
+
+    def _sync_batch(self, batch):
+        from utilities import client
+
+        start = time.perf_counter()
+        try:
+            items = client.post_new_movies_to_syncer(
+                batch, session=self._session())
+            error = None if items else "batch not accepted"
+        except Exception as e:
+            items = []
+            error = f"{type(e).__name__}: {str(e)}"
+        # Items sent in bulk are timed by their batch's round trip
+        seconds = time.perf_counter() - start
+
+        by_index = {i['index']: i for i in items}
+        unsent = [movie for index, movie in enumerate(batch)
+                  if index not in by_index]
+        spooled = self._spool(unsent)
+        results = []
+        for index, movie in enumerate(batch):
+            item = by_index.get(index)
+            if item is None and spooled:
+                ok, status = True, "spooled for retry"
+            elif item is None:
+                ok, status = False, error or "missing from response"
+            else:
+                ok, status = item['code'] in (200, 208), item['status']
+            results.append(Result(SYNC, movie['guid'], movie['path'], ok,
+                                  status, seconds))
+
+        return results
+
+    def _submit(self, executor, func, *args):
+        self._in_flight.acquire()
+        future = executor.submit(func, *args)
+        future.add_done_callback(self._collect)
+
+    def _collect(self, future):
+        self._in_flight.release()
+        with self._results_lock:
+            self.results.extend(future.result())
+
+    def run(self, items):
+        """Process every item and return a list of Result."""
+        from utilities import daemon
+
+        self._use_daemon = not self.inprocess and daemon.is_running()
+        self._sessions = []
+        self._spooled = False
+        self.results = []
+        start = time.perf_counter()
+
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix="batch") as executor:
+            for item in items:
+                if item['guid'] and item['path']:
+                    batch.append(item)
+                    if len(batch) >= config.SYNC_BATCH_SIZE:
+                        self._submit(executor, self._sync_batch, batch)
+                        batch = []
+                elif item['path'] and self.pathonly:
+                    self._submit(executor, self._timed, PATH_SYNC, item,
+                                 self._sync_path)
+                elif item['path']:
+                    with self._results_lock:
+                        self.results.append(Result(
+                            PATH_SYNC, None, item['path'], False,
+                            "IMDb guid required, pass --pathonly to allow",
+                            0))
+                elif item['guid']:
+                    self._submit(executor, self._timed, NOTIFY, item,
+                                 self._notify)
+            if batch:
+                self._submit(executor, self._sync_batch, batch)
+
+        for session in self._sessions:
+            session.close()
+        if self._spooled:
+            self._flush_spool()
+        self.elapsed = time.perf_counter() - start
+
+        return self.results
+
+    def summary(self):
+        """Summary lines: totals, then counts and per-item timings for
+        each kind of request.
+        """
+        total = len(self.results)
+        failed = sum(1 for r in self.results if not r.ok)
+        rate = total / self.elapsed if self.elapsed else 0
+        lines = [f"Batch complete: {total} items, {failed} failed in "
+                 f"{self.elapsed:.2f}s ({rate:.1f}/s)"]
+
+        for kind in (SYNC, PATH_SYNC, NOTIFY):
+            results = [r for r in self.results if r.kind == kind]
+            if not results:
+                continue
+            ok = sum(1 for r in results if r.ok)
+            seconds = sorted(r.seconds for r in results)
+            timings = " ".join(
+                f"p{pct} {utils.percentile(seconds, pct):.2f}s"
+                for pct in (50, 90))
+            lines.append(f"  {kind}: {ok} ok, {len(results) - ok} failed "
+                         f"| {timings} max {seconds[-1]:.2f}s")
+
+        return lines
+
+
+def run(args):
+    """Run plexBot.py batch input and log a summary.
+    Returns:
+        - list(Result)
+    """
+    items = items_from_args(args.imdb_guid, args.path)
+    if args.batch:
+        items = itertools.chain(items, read_items(args.batch))
+
+    runner = BatchRunner(concurrency=args.concurrency,
+                         pathonly=args.pathonly, debug=args.debug,
+                         dryrun=args.dryrun, inprocess=args.inprocess)
+    results = runner.run(items)
+    for line in runner.summary():
+        logger.info(line)
+
+    return results
@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
+import contextlib
+import fcntl
+import itertools
 import json
+import os.path
+import subprocess
+import sys
+import threading
+import time
+
 import requests
 from utilities import config
 from utilities import logger
+from utilities import utils
 
 
-def _send_post(url, data, timeout=60):
+def _send_post(url, data, timeout=60, content_type="application/json",
+               session=None):
     try:
-        r = requests.post(
+        r = (session or requests).post(
             url, data,
-            headers={"Content-Type": "application/json"},
+            headers={"Content-Type": content_type},
             timeout=timeout
         )
         logger.info(f"Response: {r.text} [{r.status_code}]")
@@ -27,6 +38,7 @@ def _get_request(url, timeout=60):
     try:
         r = requests.get(url, timeout=timeout)
         logger.info(f"Response: {r.text} [{r.status_code}]")
+        return r
 
     except requests.exceptions.ConnectionError:
         logger.error("Response: [404] Server not found")
@@ -36,7 +48,7 @@ def _get_request(url, timeout=60):
             f"Request timed out. No response after {timeout} seconds [503] ")
 
 
-def post_new_movie_to_syncer(path, imdb_guid=None, timeout=60):
+def post_new_movie_to_syncer(path, imdb_guid=None, timeout=60, session=None):
     movie_info_dict = {
         "path": path,
         "guid": imdb_guid,
@@ -46,32 +58,271 @@ def post_new_movie_to_syncer(path, imdb_guid=None, timeout=60):
 
     url = config.REMOTE_LISTENER + config.NEW_MOVIE_ENDPOINT
     logger.debug(f"Posting request to: {url} - {movie_data}")
-    _send_post(url, movie_data, timeout=timeout)
+    r = _send_post(url, movie_data, timeout=timeout, session=session)
+    if r is not None and r.status_code == 202:
+        logger.info(f"Request accepted: {json.loads(r.text)['request_id']}")
+
+    return r
 
 
-def get_test_endpoint(timeout=10):
-    url = config.REMOTE_LISTENER + config.TEST_ENDPOINT
+def get_sync_request_status(request_id, timeout=10):
+    """Poll the outcome of a request accepted by the asynchronous intake."""
+    url = config.REMOTE_LISTENER + config.SYNC_REQUEST_ENDPOINT + request_id
     logger.debug(f"Sending GET request to: {url}")
-    _get_request(url, timeout=timeout)
+    r = _get_request(url, timeout=timeout)
+    if r is None or r.status_code != 200:
+        return None
 
+    return json.loads(r.text)
 
-def post_test_endpoint(timeout=10):
-    import uuid
-    url = config.REMOTE_LISTENER + config.TEST_ENDPOINT
-    _req_uuid = str(uuid.uuid4())
-    data_dict = {
-        "uuid": _req_uuid,
-        "message": "Ping!",
-    }
 
-    data = json.dumps(data_dict)
-    logger.debug(f"Sending POST request to: {url} - {data}")
-
-    r = _send_post(url, data, timeout=timeout)
-    response_data = json.loads(r.text)
-    _res_uuid = response_data["echo"]["uuid"]
-    if _res_uuid == _req_uuid:
-        logger.info("Success! Response matches request.")
-    else:
-        logger.error("Response does not match request")
-        logger.debug(f"request: {_req_uuid} / response: {_res_uuid}")
+def _bulk_item(movie):
+    item = {"path": movie["path"], "guid": movie.get("guid")}
+    if movie.get("host"):
+        item["host"] = movie["host"]
+
+    return item
+
+
+def post_new_movies_to_syncer(movies, batch_size=None, timeout=60,
+                              session=None):
+    """Send many sync requests to the listener as NDJSON batches over one
+    keep-alive session.
+    Requires:
+        - iterable of dicts with "path" and "guid" keys, and optionally
+          "host": the SFTP host to transfer from
+    Optional:
+        - requests.Session(session): reuse a session instead of opening one
+    Returns:
+        - list(dict): per-item results reported by the listener
+    """
+    if not batch_size:
+        batch_size = config.SYNC_BATCH_SIZE
+
+    url = config.REMOTE_LISTENER + config.NEW_MOVIES_ENDPOINT
+    movies = iter(movies)
+    results = []
+    with contextlib.ExitStack() as stack:
+        if session is None:
+            session = stack.enter_context(requests.Session())
+        while True:
+            batch = list(itertools.islice(movies, batch_size))
+            if not batch:
+                break
+
+            movie_data = "\n".join(json.dumps(_bulk_item(m)) for m in batch)
+            logger.debug(f"Posting batch of {len(batch)} to: {url}")
+            r = _send_post(url, movie_data, timeout=timeout,
+                           content_type="application/x-ndjson",
+                           session=session)
+            if r is None or r.status_code != 200:
+                logger.error(f"Batch failed, {len(batch)} items not sent")
+                continue
+
+            results.extend(json.loads(r.text)["items"])
+
+    return results
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """Return the client-side spool, creating it on first use."""
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            from utilities import dbutils
+            spool_path = os.path.abspath(os.path.join(
+                os.path.dirname(os.path.dirname(__file__)),
+                os.path.expanduser(config.CLIENT_SPOOL_PATH)))
+            _spool = dbutils.SyncSpool(spool_path)
+
+    return _spool
+
+
+def spool_new_movies(movies):
+    """Store sync requests in the local spool, to be sent by flush_spool.
+    Requests already spooled for the same path or guid are ignored.
+    Requires:
+        - iterable of dicts with "path" and optionally "guid" and "host"
+    Returns:
+        - list(int): spool ids of the requests added
+    """
+    added = get_spool().add_many(
+        (m.get("guid"), m["path"], m.get("host")) for m in movies)
+    logger.debug(f"Spooled {len(added)} sync requests")
+
+    return added
+
+
+def _retry_spooled(spool, row, error):
+    delay = utils.backoff_delay(
+        row['attempts'] + 1, base_delay=config.CLIENT_SPOOL_RETRY_BASE_DELAY,
+        max_delay=config.CLIENT_SPOOL_RETRY_MAX_DELAY)
+    spool.retry(row['id'], time.time() + delay, error)
+
+
+def _flush_rows(spool, rows, session, timeout):
+    """Send one claimed batch of spooled requests. Requests the listener
+    answered are removed from the spool, the rest are scheduled for retry.
+    Returns:
+        - tuple(int(sent), bool(listener reachable))
+    """
+    done = []
+    reachable = True
+    with_guid = [row for row in rows if row['guid']]
+    path_only = [row for row in rows if not row['guid']]
+
+    if with_guid:
+        items = post_new_movies_to_syncer(
+            ({"guid": row['guid'], "path": row['path'], "host": row['host']}
+             for row in with_guid),
+            batch_size=len(with_guid), timeout=timeout, session=session)
+        by_index = {item['index']: item for item in items}
+        for index, row in enumerate(with_guid):
+            item = by_index.get(index)
+            if item is None:
+                reachable = False
+                _retry_spooled(spool, row, "listener unavailable")
+                continue
+            if item['code'] not in (200, 208):
+                logger.error(f"Dropping rejected sync request: "
+                             f"{row['guid']} - {row['path']} "
+                             f"[{item['code']}] {item.get('status')}")
+            done.append(row['id'])
+
+    for row in path_only:
+        if not reachable:
+            _retry_spooled(spool, row, "listener unavailable")
+            continue
+        r = post_new_movie_to_syncer(row['path'], timeout=timeout,
+                                     session=session)
+        if r is None or r.status_code >= 500:
+            reachable = r is not None
+            _retry_spooled(spool, row, "listener unavailable" if r is None
+                           else f"[{r.status_code}] {r.text}")
+            continue
+        if r.status_code not in (200, 202, 208):
+            logger.error(f"Dropping rejected sync request: {row['path']} "
+                         f"[{r.status_code}] {r.text}")
+        done.append(row['id'])
+
+    spool.delete(done)
+
+    return len(done), reachable
+
+
+def flush_spool(batch_size=None, timeout=60, force=False):
+    """Drain the local spool to the listener in batches, stopping early if
+    the listener cannot be reached. Requests only leave the spool once the
+    listener has answered them.
+    Optional:
+        - bool(force): also send requests still waiting on a retry
+    Returns:
+        - tuple(int(sent), int(still spooled))
+    """
+    if not batch_size:
+        batch_size = config.SYNC_BATCH_SIZE
+
+    spool = get_spool()
+    sent = 0
+    last_id = 0
+    with requests.Session() as session:
+        while True:
+            rows = spool.claim(limit=batch_size, lease_seconds=timeout * 2,
+                               force=force, after_id=last_id)
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            batch_sent, reachable = _flush_rows(spool, rows, session,
+                                                timeout)
+            sent += batch_sent
+            if not reachable:
+                break
+
+    remaining = spool.count()
+    logger.info(f"Spool flushed: {sent} sent, {remaining} still spooled")
+
+    return sent, remaining
+
+
+def drain_spool(deadline=None, timeout=None):
+    """Flush the spool, then keep retrying whatever is left as each
+    request's backoff comes due, until the spool is empty or deadline
+    seconds have passed. Only one process drains at a time; any other
+    returns after its first flush and leaves the rest to it.
+    Returns:
+        - tuple(int(sent), int(still spooled))
+    """
+    if deadline is None:
+        deadline = config.CLIENT_SPOOL_DRAIN_DEADLINE
+    if timeout is None:
+        timeout = config.CLIENT_SPOOL_TIMEOUT
+
+    give_up = time.time() + deadline
+    sent, remaining = flush_spool(timeout=timeout)
+    if not remaining:
+        return sent, remaining
+
+    spool = get_spool()
+    with open(f"{spool.db_path}.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug("Spool already being drained by another process")
+            return sent, remaining
+
+        while remaining and time.time() < give_up:
+            next_attempt = spool.next_attempt() or time.time()
+            time.sleep(max(1.0, min(next_attempt, give_up) - time.time()))
+            batch_sent, remaining = flush_spool(timeout=timeout)
+            sent += batch_sent
+
+    if remaining:
+        logger.warning(f"Gave up draining the spool after {deadline} "
+                       f"seconds, {remaining} requests still spooled")
+
+    return sent, remaining
+
+
+def flush_spool_detached():
+    """Start drain_spool in a separate process that outlives the caller,
+    so a post-processing hook returns without waiting on the listener.
+    """
+    subprocess.Popen(
+        [sys.executable, "-c",
+         "from utilities import client; client.drain_spool()"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def submit_new_movie(path, imdb_guid=None, timeout=None):
+    """Submit a sync request from a post-processing hook. With
+    CLIENT_SPOOL enabled, the request is stored locally and a detached
+    process flushes the spool, so the hook returns as soon as the insert
+    commits. Otherwise it is posted directly.
+    """
+    if not config.CLIENT_SPOOL:
+        return post_new_movie_to_syncer(path=path, imdb_guid=imdb_guid,
+                                        timeout=timeout or 60)
+
+    try:
+        added = spool_new_movies([{"path": path, "guid": imdb_guid}])
+    except Exception as e:
+        logger.error(f"Failed to spool sync request, sending directly: "
+                     f"{str(e)}")
+        return post_new_movie_to_syncer(path=path, imdb_guid=imdb_guid,
+                                        timeout=timeout or 60)
+    if not added:
+        logger.info(f"Sync request already spooled: {imdb_guid} - {path}")
+
+    try:
+        flush_spool_detached()
+    except OSError as e:
+        logger.warning(f"Could not start spool flush, request stays "
+                       f"spooled until the next one: {str(e)}")
+
+    return added
@@ -5,12 +5,22 @@ You MUST rename this file to config.py in order for these scripts to function.
 """
 
 LOG_FILE = './plexbot.log'  # Log file location. No need to change this.
+LOG_LEVEL = 'DEBUG'   # Minimum level logged: DEBUG, INFO, WARNING, ERROR or CRITICAL
+LOG_BUFFERED = True   # Write the log in batches from a background thread
+LOG_MAX_BYTES = 10 * 1024 * 1024   # Rotate the log at this size in bytes (0 to disable)
+LOG_ROTATE_INTERVAL = 0   # Also rotate the log after this many seconds (0 to disable)
+LOG_BACKUP_COUNT = 5   # Rotated log files to keep
+LOG_FORMAT = 'text'   # 'text' or 'json': JSON lines with level, component and correlation id
 OMDB_API_KEY = '<YOUR OMDB API KEY>'  # Get this from: http://www.omdbapi.com/apikey.aspx
 
 
 ## Plex Config ##
 PLEX_AUTH_TYPE = 'token'   # 'token' or 'user
 PLEX_SERVER_URL = ''   # <YOUR PLEX SERVER URL>'
+PLEX_PAGE_SIZE = 500   # Items fetched per request when reading a whole Plex library
+blacklist = []   # IMDb guids plexMatch never requests
+PLEX_SOURCE_SERVERS = {}   # {<source plex server url>: <sftp host to transfer from, or None for REMOTE_FILE_SERVER>}
+PLEX_SOURCE_SELECTION = 'resolution'   # 'resolution' or 'throughput': how plexMatch picks between sources
 
 # User Auth:
 PLEX_SERVER_NAME = ''   # <YOUR PLEX SERVER NAME>
@@ -28,11 +38,45 @@ REMOTE_LISTENER = ''   # <'ip:port' - Remote server to inform of new movies>
 
 # Server / Listener:
 REMOTE_FILE_SERVER = ''   # <Remote server ip>
+REMOTE_FILE_SERVERS = []   # Other SFTP hosts sync requests may name as their source
 REMOTE_USER = ''   # <user for remote server>
 IN_PROGRESS_DIR = '~/Downloads/'   # <path for in progress downloads>
 FILE_TRANSFER_COMPLETE_DIR = '~/Downloads/'   # <final destination path for downloads>
 
 NEW_MOVIE_ENDPOINT = '/new_movie/'
+NEW_MOVIES_ENDPOINT = '/new_movies/'   # Bulk sync requests (JSON array or NDJSON)
+SYNC_BATCH_SIZE = 200   # Max items per bulk sync request sent by the client
+CLIENT_SPOOL = True   # Store sync requests in a local db before sending, so none are lost while the listener is down
+CLIENT_SPOOL_PATH = 'sync_spool.db'   # Relative to the minibot directory
+CLIENT_SPOOL_TIMEOUT = 10   # Seconds the background flush waits on the listener; unsent requests stay spooled
+CLIENT_SPOOL_RETRY_BASE_DELAY = 30   # Seconds before a spooled request is retried; doubles per attempt, with jitter
+CLIENT_SPOOL_RETRY_MAX_DELAY = 3600   # Upper bound on the delay between retries
+CLIENT_SPOOL_DRAIN_DEADLINE = 86400   # Seconds a background flush keeps retrying before leaving the rest to the next one or --flush
+CLI_CONCURRENCY = 4   # Requests plexBot.py works on at once for batch input (--batch or repeated -i/-p)
+SYNC_REQUEST_ENDPOINT = '/sync_requests/'   # Poll async intake results: <endpoint><request_id>
+ASYNC_INTAKE = False   # Accept /new_movie/ requests with 202 and resolve them in the background
+RESOLVER_WORKERS = 2   # Background OMDb resolver threads used by ASYNC_INTAKE
+QUEUE_ENDPOINT = '/queue'   # Paginated transfer queue status
+MOVIE_STATUS_ENDPOINT = '/movies/'   # Single movie status: <endpoint><guid>
+QUEUE_PAGE_SIZE = 50   # Default page size for the queue endpoint (max 500)
+EVENTS_ENDPOINT = '/events'   # Server-Sent Events stream of queue and transfer events
+EVENT_BUFFER_SIZE = 256   # Events buffered per subscriber before the oldest are dropped
+EVENT_PROGRESS_INTERVAL = 1.0   # Minimum seconds between progress events per transfer
+DAEMON_SOCKET = '/tmp/minibot.sock'   # Unix socket the notification daemon (plexBot.py --daemon) listens on
+DAEMON_CONNECT_TIMEOUT = 0.5   # Seconds the CLI waits for the daemon before sending in-process
+OMDB_CACHE_TTL = 86400   # Seconds the daemon keeps OMDb results in memory
+METRICS_ENDPOINT = '/metrics'   # Prometheus text format metrics
+TRACE_FILE = ''   # Write pipeline stage timings here in Chrome trace format, e.g. './trace.json' (empty to disable)
+TRANSFER_STATS_ENDPOINT = '/transfers/stats'   # Throughput percentiles
+EMBEDDED_TRANSFER_QUEUE = False   # Run the transfer queue inside the server process (use a single WSGI process)
+EMBEDDED_QUEUE_POLL_INTERVAL = 60   # Seconds between db checks when requests are handed off in memory
+TRANSFER_LEASE_SECONDS = 300   # Lease on claimed items; renewed while held, reclaimed by others once expired
+TRANSFER_CLAIM_BATCH = 1   # Items a syncer claims from the db at a time
+TRANSFER_MAX_ATTEMPTS = 5   # Attempts per item before it is marked failed
+TRANSFER_RETRY_BASE_DELAY = 60   # Seconds before the first retry; doubles per attempt, with jitter
+TRANSFER_RETRY_MAX_DELAY = 3600   # Upper bound on the delay between retries
+CIRCUIT_FAILURE_THRESHOLD = 5   # Consecutive failures before calls to Plex, OMDb or Slack fail fast
+CIRCUIT_RESET_TIMEOUT = 60   # Seconds an open circuit waits before letting a trial call through
 
 SYNCED_FILE_PERMISSIONS = 0o775
 
@@ -44,4 +88,13 @@ DEFAULT_SLACK_USER = '<YOUR DEFAULT USERNAME TO SEND MESSAGES AS>'
 DEFAULT_SLACK_ROOM = '<DEFAULT CHANNEL TO SEND MESSAGE TO>'
 DEBUG_SLACK_ROOM = '<DEFAULT CHANNEL TO SEND MESSAGE TO FOR DEV/DEBUG PURPOSES>'
 SLACK_BOT_TOKEN = '<YOUR SLACK BOT TOKEN>'
+SLACK_PROGRESS_UPDATES = False   # Post one message per transfer with SLACK_BOT_TOKEN and edit it as the transfer advances
+SLACK_PROGRESS_CHANNEL = '<CHANNEL TO POST TRANSFER PROGRESS IN>'
+SLACK_PROGRESS_INTERVAL = 10   # Minimum seconds between edits of a progress message
+SLACK_OUTBOX = True   # Queue syncer notifications in the db and send them from a background thread (False sends inline)
+SLACK_OUTBOX_MAX_MESSAGES = 1000   # Undelivered messages kept; the oldest are dropped beyond this
+SLACK_OUTBOX_BATCH = 20   # Messages the sender loads from the db at a time
+SLACK_MAX_ATTEMPTS = 8   # Send attempts per message before it is dropped (rate limits do not count)
+SLACK_RETRY_BASE_DELAY = 5   # Seconds before the first retry; doubles per attempt, with jitter
+SLACK_RETRY_MAX_DELAY = 600   # Upper bound on the delay between retries
 DEFAULT_TITLE = 'Server Announcement: '
@@ -10,3 +10,5 @@ YEAR_TOKEN = 'y'
 PLOT_TOKEN = 'plot'
 PLOT_SHORT = 'short'
 PLOT_LONG = 'long'
+
+SLACK_API_URL = 'https://slack.com/api/'
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""Resident notification daemon. Keeps Plex, OMDb and HTTP connections
+open and takes new movie notifications on a Unix socket, one JSON line
+per request and reply.
+"""
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+from queue import Empty
+from queue import Queue
+from types import SimpleNamespace
+
+from utilities import config
+from utilities import logger
+from utilities import utils
+from utilities.utils import StoppableThread
+
+
+class DaemonException(Exception):
+    """Custom exception for notification daemon failures."""
+    pass
+
+
+def _request(message, socket_path=None, timeout=None):
+    """Send one JSON message to the daemon and return its decoded reply,
+    or None if no daemon could be connected to on socket_path. Once the
+    message may have reached the daemon, a missing reply raises
+    DaemonException instead, so the caller does not send it twice.
+    """
+    if not socket_path:
+        socket_path = config.DAEMON_SOCKET
+    if timeout is None:
+        timeout = config.DAEMON_CONNECT_TIMEOUT
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            logger.debug(f"Notification daemon unavailable: {socket_path} "
+                         f"- {type(e).__name__}")
+            return None
+
+        try:
+            sock.sendall(json.dumps(message).encode() + b"\n")
+            with sock.makefile("rb") as reply:
+                line = reply.readline()
+        except OSError as e:
+            raise DaemonException(f"No reply from notification daemon: "
+                                  f"{socket_path} - {type(e).__name__}")
+
+    if not line:
+        raise DaemonException(f"Notification daemon closed the "
+                              f"connection: {socket_path}")
+
+    return json.loads(line)
+
+
+def is_running(socket_path=None):
+    """Returns True if a daemon is listening on socket_path, even if it
+    is too busy to answer.
+    """
+    try:
+        return _request({"command": "ping"},
+                        socket_path=socket_path) is not None
+    except DaemonException as e:
+        logger.warning(str(e))
+        return True
+
+
+def forward_notification(imdb_guid, debug=False, dryrun=False,
+                         socket_path=None):
+    """Hand a new movie notification to a running daemon.
+    Requires:
+        - str(imdb_guid)
+    Returns:
+        - str(request_id) if the daemon accepted it, otherwise None
+    Raises:
+        - DaemonException if the daemon may have the request but did not
+          answer; sending it again could notify twice
+    """
+    reply = _request({
+        "command": "notify",
+        "imdb_guid": imdb_guid,
+        "debug": debug,
+        "dryrun": dryrun,
+    }, socket_path=socket_path)
+
+    if not reply:
+        return None
+    if reply.get("status") != "accepted":
+        logger.error(f"Notification daemon rejected request: {reply}")
+        return None
+
+    logger.info(f"Notification queued by daemon: {reply['request_id']}")
+
+    return reply['request_id']
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            message = json.loads(line)
+            reply = self.server.daemon.handle(message)
+        except Exception as e:
+            reply = {"status": "error", "message": str(e)}
+
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class NotificationDaemon(object):
+    """Listens on a Unix socket and sends new movie notifications from a
+    single worker thread, reusing its connections between requests.
+    Optional kwargs:
+        - socket_path (str): defaults to config.DAEMON_SOCKET
+    """
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or config.DAEMON_SOCKET
+        self.queue = Queue()
+        self.notifier = None
+        self.session = None
+        self._server = None
+        self._worker = None
+
+    def _connect(self):
+        import requests
+        from utilities import plexutils
+
+        self.session = requests.Session()
+        self.notifier = plexutils.MovieNotification(
+            session=self.session, omdb_cache_ttl=config.OMDB_CACHE_TTL,
+            auth_type=config.PLEX_AUTH_TYPE)
+        try:
+            self.notifier.connect()
+        except Exception as e:
+            logger.warning(f"Plex unavailable, will connect on first "
+                           f"request: {str(e)}")
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        if is_running(socket_path=self.socket_path):
+            raise DaemonException(
+                f"Notification daemon already running: {self.socket_path}")
+
+        logger.debug(f"Removing stale socket: {self.socket_path}")
+        os.unlink(self.socket_path)
+
+    def start(self):
+        self._remove_stale_socket()
+        self._connect()
+
+        self._worker = StoppableThread(target=self._run,
+                                       name="notification-daemon",
+                                       daemon=True)
+        self._worker.start()
+
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        logger.info(f"Notification daemon listening: {self.socket_path}")
+
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self, timeout=30):
+        if self._server:
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+        if self._worker:
+            self.queue.join()
+            self._worker.stop()
+            self._worker.join(timeout)
+            self._worker = None
+
+        if self.session:
+            self.session.close()
+
+        logger.info("Notification daemon stopped")
+
+    def handle(self, message):
+        command = message.get("command")
+        if command == "ping":
+            return {"status": "ok", "queued": self.queue.qsize()}
+
+        if command != "notify":
+            return {"status": "error",
+                    "message": f"Unknown command: {command}"}
+
+        if not message.get("imdb_guid"):
+            return {"status": "error", "message": "imdb_guid required"}
+
+        request_id = utils.new_correlation_id()
+        self.queue.put((request_id, SimpleNamespace(
+            imdb_guid=message["imdb_guid"],
+            debug=bool(message.get("debug")),
+            dryrun=bool(message.get("dryrun")))))
+
+        return {"status": "accepted", "request_id": request_id}
+
+    def _run(self):
+        from utilities import plexutils
+
+        while not threading.current_thread().stopped():
+            try:
+                request_id, args = self.queue.get(timeout=1)
+            except Empty:
+                continue
+
+            try:
+                with utils.log_context(correlation_id=request_id,
+                                       component="daemon"):
+                    logger.info(f"Sending new movie notification: "
+                                f"{args.imdb_guid}")
+                    plexutils.send_new_movie_slack_notification(
+                        args, notifier=self.notifier, session=self.session)
+            except Exception as e:
+                logger.error(f"Failed to send notification: "
+                             f"{args.imdb_guid} \n{str(e)}")
+                # The kept connection may have gone stale, reconnect on the
+                # next request
+                self.notifier.reset()
+            finally:
+                self.queue.task_done()
+
+
+def run_daemon(socket_path=None):
+    signal.signal(signal.SIGINT, utils.interrupt_handler)
+    signal.signal(signal.SIGTERM, utils.interrupt_handler)
+
+    daemon = NotificationDaemon(socket_path=socket_path).start()
+    try:
+        daemon.serve_forever()
+    except utils.SigInt as e:
+        logger.info(str(e))
+    finally:
+        daemon.stop()
@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
+import contextlib
+import os
 import os.path
 import sqlite3 as sql
+import threading
+import time
+import weakref
+
+from utilities import utils
 
 # database info
 _db_filename = "remote_movies.db"
@@ -16,10 +23,228 @@ _remote_path_col = "remote_path"
 _queued_col = "queued"
 _complete_col = "complete"
 
-_update_queued_col_statement = "UPDATE remote_movies SET queued=? WHERE guid=?"
-_update_complete_col_statement = "UPDATE remote_movies SET complete=? WHERE guid=?"
+_state_col = "state"
+
+# Insert a new movie, or revive a previously failed one so it can be
+# requested again. Any other existing guid leaves rowcount at 0.
+_insert_statement = "INSERT INTO remote_movies " \
+                    "(guid, remote_path, remote_host, correlation_id, " \
+                    "updated_at) VALUES (?, ?, ?, ?, ?) " \
+                    "ON CONFLICT(guid) DO UPDATE SET " \
+                    "remote_path=excluded.remote_path, " \
+                    "remote_host=excluded.remote_host, " \
+                    "correlation_id=excluded.correlation_id, " \
+                    "state='pending', " \
+                    "queued=0, complete=0, bytes_transferred=0, " \
+                    "total_bytes=NULL, updated_at=excluded.updated_at, " \
+                    "attempts=0, next_attempt_at=NULL, last_error=NULL " \
+                    "WHERE state='failed'"
+_update_state_statement = "UPDATE remote_movies SET state=?, queued=?, " \
+                          "complete=?, updated_at=? WHERE guid=?"
+# Leaving the queue (complete, failed, back to pending) also drops the lease
+_finish_state_statement = "UPDATE remote_movies SET state=?, queued=?, " \
+                          "complete=?, updated_at=?, lease_owner=NULL, " \
+                          "lease_expires=NULL WHERE guid=?"
+# A pending row waiting out a retry delay is not ready yet
+_ready_condition = "(next_attempt_at IS NULL OR next_attempt_at<=?)"
+# A queued or in-progress row whose lease ran out belongs to a dead worker
+_claimable_condition = f"((state='pending' AND {_ready_condition}) OR " \
+                       "(state IN ('queued', 'in_progress') AND " \
+                       "(lease_expires IS NULL OR lease_expires<?)))"
+_update_progress_statement = "UPDATE remote_movies SET " \
+                             "bytes_transferred=?, total_bytes=?, " \
+                             "updated_at=? WHERE guid=?"
 _remove_guid_statement = "DELETE FROM remote_movies WHERE guid=?"
 
+# remote_movies transfer states
+PENDING = "pending"
+QUEUED = "queued"
+IN_PROGRESS = "in_progress"
+COMPLETE = "complete"
+FAILED = "failed"
+MOVIE_STATES = (PENDING, QUEUED, IN_PROGRESS, COMPLETE, FAILED)
+
+# legacy (queued, complete) flags and update statement for each state
+_state_transitions = {
+    PENDING: (0, 0, _finish_state_statement),
+    QUEUED: (1, 0, _update_state_statement),
+    IN_PROGRESS: (1, 0, _update_state_statement),
+    COMPLETE: (0, 1, _finish_state_statement),
+    FAILED: (0, 0, _finish_state_statement),
+}
+
+# stay well below SQLITE_MAX_VARIABLE_NUMBER in "IN (...)" lookups
+_max_variables = 500
+
+# sync request states used by asynchronous intake
+PENDING_RESOLUTION = "pending_resolution"
+RESOLVING = "resolving"
+RESOLVED = "queued"
+DUPLICATE = "duplicate"
+
+# Columns added after the first release of a table. Existing databases get
+# them through ALTER TABLE before schema.sql creates indexes on them.
+_migrations = {
+    "remote_movies": [
+        ("state", "text not null default 'pending'",
+         "UPDATE remote_movies SET state = CASE "
+         "WHEN complete=1 THEN 'complete' "
+         "WHEN queued=1 THEN 'queued' ELSE 'pending' END"),
+        ("bytes_transferred", "integer default 0", None),
+        ("total_bytes", "integer", None),
+        ("updated_at", "real default 0", None),
+        ("lease_owner", "text", None),
+        ("lease_expires", "real", None),
+        ("attempts", "integer default 0", None),
+        ("next_attempt_at", "real", None),
+        ("last_error", "text", None),
+        ("remote_host", "text", None),
+        ("correlation_id", "text", None),
+    ],
+    "library_snapshot": [
+        ("resolution", "text", None),
+    ],
+}
+
+
+class ConnectionManager(object):
+    """Hands out one long-lived sqlite connection per thread (and per
+    process, so a forked WSGI worker never reuses its parent's handle).
+    Connections use WAL journaling so readers do not block the writer,
+    wait on busy_timeout instead of failing with "database is locked",
+    and keep a cache of prepared statements.
+    """
+
+    def __init__(self, db_path, busy_timeout=30000, cached_statements=256):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connect(self):
+        con = sql.connect(self.db_path,
+                          timeout=self.busy_timeout / 1000,
+                          isolation_level=None,
+                          check_same_thread=False,
+                          cached_statements=self.cached_statements)
+        con.row_factory = sql.Row
+        con.text_factory = lambda x: str(x, "utf-8", "ignore")
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        con.execute("PRAGMA synchronous=NORMAL")
+
+        return con
+
+    def get(self):
+        con = getattr(self._local, "connection", None)
+        if con is not None and self._local.pid == os.getpid():
+            return con
+
+        con = self._connect()
+        self._local.connection = con
+        self._local.pid = os.getpid()
+        self._local.depth = 0
+        with self._lock:
+            self._close_dead()
+            self._connections.append(
+                (weakref.ref(threading.current_thread()), con))
+
+        return con
+
+    def _close_dead(self):
+        """Close connections that belonged to threads which have exited."""
+        alive = []
+        for thread_ref, con in self._connections:
+            thread = thread_ref()
+            if thread is None or not thread.is_alive():
+                con.close()
+            else:
+                alive.append((thread_ref, con))
+        self._connections = alive
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """Run the enclosed statements in one transaction, committing on
+        success and rolling back on error. Nested use joins the outer
+        transaction. immediate takes the write lock up front.
+        """
+        con = self.get()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield con.cursor()
+            finally:
+                self._local.depth -= 1
+            return
+
+        con.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self._local.depth = 1
+        try:
+            yield con.cursor()
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        with self._lock:
+            for _, con in self._connections:
+                con.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class KnownMovieIndex(object):
+    """In-memory index of requested guids and remote paths. A bloom filter
+    answers most "never seen" lookups without touching the sets. Removed
+    keys are only dropped from the sets, because a bloom filter cannot
+    forget; a stale bloom hit just falls through to the set check.
+    """
+
+    def __init__(self, capacity=100000):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._guids = set()
+        self._paths = set()
+        self._bloom = utils.BloomFilter(capacity)
+
+    def __len__(self):
+        return len(self._guids)
+
+    def add(self, guid=None, path=None):
+        with self._lock:
+            if guid:
+                self._guids.add(guid)
+                self._bloom.add(f"guid:{guid}")
+            if path:
+                self._paths.add(path)
+                self._bloom.add(f"path:{path}")
+            if self._bloom.count > self._capacity:
+                self._rebuild(self._capacity * 2)
+
+    def discard(self, guid=None, path=None):
+        with self._lock:
+            self._guids.discard(guid)
+            self._paths.discard(path)
+
+    def contains_guid(self, guid):
+        return f"guid:{guid}" in self._bloom and guid in self._guids
+
+    def contains_path(self, path):
+        return f"path:{path}" in self._bloom and path in self._paths
+
+    def _rebuild(self, capacity):
+        self._capacity = capacity
+        self._bloom = utils.BloomFilter(capacity)
+        for guid in self._guids:
+            self._bloom.add(f"guid:{guid}")
+        for path in self._paths:
+            self._bloom.add(f"path:{path}")
+
 
 class FileTransferDB(object):
     def __init__(self,
@@ -29,102 +254,744 @@ class FileTransferDB(object):
         self.db_path = db_path
         self.schema_path = schema_path
         self.table_name = table_name
+        self._connections = ConnectionManager(db_path)
         self._create_from_schema()
+        self._known_movies = None
+        self._known_movies_lock = threading.Lock()
 
         self.guid_col = _guid_col
         self.rempath_col = _remote_path_col
         self.qd_col = _queued_col
         self.complete_col = _complete_col
+        self.state_col = _state_col
 
     def _create_from_schema(self):
-        connection = sql.connect(self.db_path)
-        connection.row_factory = sql.Row
-        cur = connection.cursor()
+        with self._connections.transaction(immediate=True) as cur:
+            self._migrate(cur)
         with open(self.schema_path) as schema:
-            cur.executescript(schema.read())
-
-    def insert(self, guid, remote_path):
-        statement = f"INSERT INTO remote_movies " \
-                    f"(guid, remote_path) VALUES (?, ?)"
-        params = (guid, remote_path)
-        with sql.connect(self.db_path) as con:
-            con.row_factory = sql.Row
-            con.text_factory = lambda x: str(x, "utf-8", "ignore")
-            cur = con.cursor()
-            cur.execute(statement, params)
-            con.commit()
+            self._connections.get().executescript(schema.read())
+
+    def close(self):
+        self._connections.close()
+
+    @staticmethod
+    def _migrate(cur):
+        for table, columns in _migrations.items():
+            cur.execute(f"PRAGMA table_info({table})")
+            existing = [row[1] for row in cur.fetchall()]
+            if not existing:
+                continue
+
+            for name, definition, backfill in columns:
+                if name in existing:
+                    continue
+                cur.execute(
+                    f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                if backfill:
+                    cur.execute(backfill)
+
+    def insert(self, guid, remote_path, remote_host=None,
+               correlation_id=None):
+        params = (guid, remote_path, remote_host, correlation_id,
+                  time.time())
+        if self._execute_sql(_insert_statement, params) == 0:
+            raise sql.IntegrityError(
+                f"UNIQUE constraint failed: remote_movies.guid: {guid}")
+
+        if self._known_movies is not None:
+            self._known_movies.add(guid, remote_path)
+
+    def insert_many(self, items):
+        """Insert several (guid, remote_path) pairs in a single transaction
+        with one executemany. Existing guids are looked up first so that a
+        duplicate only skips its own row, not the whole batch; previously
+        failed guids are revived as with insert.
+        Requires:
+            - list of (guid, remote_path) tuples, optionally followed by
+              remote_host and correlation_id
+        Returns:
+            - list(bool): True for each inserted item, False for duplicates
+        """
+        items = list(items)
+        now = time.time()
+        with self._connections.transaction(immediate=True) as cur:
+            existing = {}
+            guids = [item[0] for item in items]
+            for i in range(0, len(guids), _max_variables):
+                chunk = guids[i:i + _max_variables]
+                placeholders = ", ".join("?" for _ in chunk)
+                cur.execute(f"SELECT guid, state FROM remote_movies "
+                            f"WHERE guid IN ({placeholders})", chunk)
+                existing.update((row[0], row[1]) for row in cur.fetchall())
+
+            inserted = []
+            rows = []
+            for guid, remote_path, *extra in items:
+                new = existing.get(guid, FAILED) == FAILED
+                inserted.append(new)
+                if new:
+                    existing[guid] = PENDING
+                    remote_host, correlation_id = (extra + [None, None])[:2]
+                    rows.append((guid, remote_path, remote_host,
+                                 correlation_id, now))
+            cur.executemany(_insert_statement, rows)
+
+        if self._known_movies is not None:
+            for (guid, remote_path, *_), new in zip(items, inserted):
+                if new:
+                    self._known_movies.add(guid, remote_path)
+
+        return inserted
+
+    def _query(self, statement, params=()):
+        return self._connections.get().execute(statement, params)
 
     def _select_movie(self, query):
         query_sql = f"SELECT * FROM remote_movies WHERE {query}"
-        with sql.connect(self.db_path) as con:
-            con.row_factory = sql.Row
-            con.text_factory = lambda x: str(x, "utf-8", "ignore")
-            cur = con.cursor()
-            cur.execute(query_sql)
-
-            return cur
+        return self._query(query_sql)
 
     def select_guid(self, guid):
         statement = f"SELECT * FROM remote_movies WHERE guid=?"
-        params = (guid,)
-        with sql.connect(self.db_path) as con:
-            con.row_factory = sql.Row
-            con.text_factory = lambda x: str(x, "utf-8", "ignore")
-            cur = con.cursor()
-            cur.execute(statement, params)
-            result = cur.fetchone()
+        return self._query(statement, (guid,)).fetchone()
 
-        return result
+    def select_path(self, remote_path):
+        statement = "SELECT * FROM remote_movies WHERE remote_path=?"
+        return self._query(statement, (remote_path,)).fetchone()
+
+    @property
+    def known_movies(self):
+        """Index of guids and paths already requested, loaded on first use
+        and kept current by this object's inserts and deletes.
+        """
+        with self._known_movies_lock:
+            if self._known_movies is None:
+                statement = "SELECT guid, remote_path FROM remote_movies " \
+                            "WHERE state != ?"
+                rows = self._query(statement, (FAILED,)).fetchall()
+
+                index = KnownMovieIndex(
+                    capacity=max(100000, 2 * len(rows)))
+                for guid, remote_path in rows:
+                    index.add(guid, remote_path)
+                self._known_movies = index
+
+        return self._known_movies
+
+    def is_requested(self, guid=None, remote_path=None):
+        """Check whether a guid or path has already been requested, without
+        any network I/O. A hit in the in-memory index is confirmed against
+        the database, since another process may have failed the item since
+        the index was loaded; failed items may be requested again.
+        Returns:
+            - bool
+        """
+        index = self.known_movies
+        lookups = (
+            (guid, index.contains_guid, self.select_guid, "guid"),
+            (remote_path, index.contains_path, self.select_path, "path"),
+        )
+        for key, contains, select, kind in lookups:
+            if not key or not contains(key):
+                continue
+            row = select(key)
+            if row and row[_state_col] != FAILED:
+                return True
+            index.discard(**{kind: key})
+
+        return False
 
     def select_all_movies(self):
         query_sql = "SELECT * FROM remote_movies"
-        with sql.connect(self.db_path) as con:
-            con.row_factory = sql.Row
-            con.text_factory = lambda x: str(x, "utf-8", "ignore")
-            cur = con.cursor()
-            cur.execute(query_sql)
-            rows = cur.fetchall()
-
-        return rows
+        return self._query(query_sql).fetchall()
 
     def select_all_unqueued_movies(self):
-        unqueued_query = "queued = 0 AND complete = 0"
+        unqueued_query = "state = 'pending'"
         cur = self._select_movie(unqueued_query)
         rows = cur.fetchall()
 
         return rows
 
     def select_all_queued_incomplete(self):
-        incomplete_query = "queued = 1 AND complete = 0"
+        incomplete_query = "state IN ('queued', 'in_progress')"
         cur = self._select_movie(incomplete_query)
         rows = cur.fetchall()
 
         return rows
 
     def select_one_incomplete(self):
-        incomplete_query = "queued = 1 AND complete = 0"
+        incomplete_query = "state IN ('queued', 'in_progress')"
         cur = self._select_movie(incomplete_query)
         result = cur.fetchone()
 
         return result
 
+    def select_movies_page(self, states=MOVIE_STATES, after_id=0, limit=50):
+        """Return up to limit movies in the given states with an id greater
+        than after_id, ordered by id. Served from the (state, id) index.
+        """
+        placeholders = ", ".join("?" for _ in states)
+        statement = f"SELECT * FROM remote_movies " \
+                    f"WHERE state IN ({placeholders}) AND id > ? " \
+                    f"ORDER BY id LIMIT ?"
+        params = (*states, after_id, limit)
+        return self._query(statement, params).fetchall()
+
+    def count_by_state(self):
+        statement = "SELECT state, COUNT(*) FROM remote_movies GROUP BY state"
+        counts = {row[0]: row[1] for row in self._query(statement)}
+
+        return {state: counts.get(state, 0) for state in MOVIE_STATES}
+
     def _execute_sql(self, statement, params):
-        with sql.connect(self.db_path) as con:
-            cur = con.cursor()
+        """Run one write statement in its own transaction.
+        Returns:
+            - int: number of rows changed
+        """
+        with self._connections.transaction() as cur:
             cur.execute(statement, params)
-            con.commit()
+
+        return cur.rowcount
+
+    def mark_many(self, guids, state):
+        """Move several movies to state in a single transaction.
+        Complete, failed and pending also drop any lease.
+        """
+        guids = list(guids)
+        queued, complete, statement = _state_transitions[state]
+        now = time.time()
+        with self._connections.transaction() as cur:
+            cur.executemany(statement, ((state, queued, complete, now, guid)
+                                        for guid in guids))
+
+        if state == FAILED and self._known_movies is not None:
+            self._forget(guids)
 
     def mark_queued(self, guid):
-        self._execute_sql(_update_queued_col_statement, (1, guid,))
-        self._execute_sql(_update_complete_col_statement, (0, guid,))
+        self.mark_many([guid], QUEUED)
+
+    def mark_in_progress(self, guid):
+        self.mark_many([guid], IN_PROGRESS)
 
     def mark_complete(self, guid):
-        self._execute_sql(_update_queued_col_statement, (0, guid,))
-        self._execute_sql(_update_complete_col_statement, (1, guid,))
+        self.mark_many([guid], COMPLETE)
 
     def mark_unqueued_incomplete(self, guid):
-        self._execute_sql(_update_queued_col_statement, (0, guid,))
-        self._execute_sql(_update_complete_col_statement, (0, guid,))
+        self.mark_many([guid], PENDING)
+
+    def mark_failed(self, guid):
+        self.mark_many([guid], FAILED)
+
+    def _forget(self, guids):
+        for guid in guids:
+            row = self.select_guid(guid)
+            path = row[_remote_path_col] if row else None
+            self._known_movies.discard(guid=guid, path=path)
+
+    def update_progress(self, guid, bytes_transferred, total_bytes):
+        self._execute_sql(_update_progress_statement,
+                          (bytes_transferred, total_bytes, time.time(), guid))
+
+    def claim(self, worker_id, limit=1, lease_seconds=300):
+        """Atomically lease up to limit claimable movies to worker_id and
+        mark them queued. Pending rows come first, in id order, followed by
+        rows whose lease has expired. Pending rows scheduled for a later
+        retry are skipped until their next_attempt_at has passed. The write
+        lock is taken before the rows are chosen, so two workers can never
+        claim the same row.
+        Returns:
+            - list of claimed rows
+        """
+        now = time.time()
+        with self._connections.transaction(immediate=True) as cur:
+            cur.execute(f"SELECT id FROM remote_movies WHERE state=? "
+                        f"AND {_ready_condition} ORDER BY id LIMIT ?",
+                        (PENDING, now, limit))
+            ids = [row[0] for row in cur.fetchall()]
+            if len(ids) < limit:
+                cur.execute("SELECT id FROM remote_movies "
+                            "WHERE state IN (?, ?) AND "
+                            "(lease_expires IS NULL OR lease_expires<?) "
+                            "ORDER BY lease_expires LIMIT ?",
+                            (QUEUED, IN_PROGRESS, now, limit - len(ids)))
+                ids.extend(row[0] for row in cur.fetchall())
+            if not ids:
+                return []
+
+            placeholders = ", ".join("?" for _ in ids)
+            cur.execute(f"UPDATE remote_movies SET state=?, queued=1, "
+                        f"complete=0, lease_owner=?, lease_expires=?, "
+                        f"updated_at=? WHERE id IN ({placeholders})",
+                        (QUEUED, worker_id, now + lease_seconds, now, *ids))
+            cur.execute(f"SELECT * FROM remote_movies "
+                        f"WHERE id IN ({placeholders}) ORDER BY id", ids)
+            rows = cur.fetchall()
+
+        return rows
+
+    def claim_guids(self, worker_id, guids, lease_seconds=300):
+        """Lease the given movies to worker_id where they are claimable,
+        in a single transaction.
+        Returns:
+            - list(str): guids now leased to worker_id
+        """
+        guids = list(guids)
+        now = time.time()
+        expires = now + lease_seconds
+        statement = f"UPDATE remote_movies SET state=?, queued=1, " \
+                    f"complete=0, lease_owner=?, lease_expires=?, " \
+                    f"updated_at=? WHERE guid=? AND {_claimable_condition} " \
+                    f"RETURNING guid"
+        claimed = []
+        with self._connections.transaction(immediate=True) as cur:
+            for guid in guids:
+                cur.execute(statement, (QUEUED, worker_id, expires, now,
+                                        guid, now, now))
+                claimed.extend(row[0] for row in cur.fetchall())
+
+        return claimed
+
+    def claim_guid(self, worker_id, guid, lease_seconds=300):
+        """Lease one specific movie to worker_id if it is claimable.
+        Returns:
+            - bool: True if the lease was granted
+        """
+        return bool(self.claim_guids(worker_id, [guid],
+                                     lease_seconds=lease_seconds))
+
+    def schedule_retry(self, guid, max_attempts, base_delay=60,
+                       max_delay=3600, error=None):
+        """Record a failed attempt on guid. The movie goes back to pending
+        with next_attempt_at set by exponential backoff with jitter, or to
+        failed once max_attempts attempts have been made.
+        Returns:
+            - float(next_attempt_at), or None if the movie was given up on
+        """
+        now = time.time()
+        with self._connections.transaction(immediate=True) as cur:
+            cur.execute("SELECT attempts FROM remote_movies WHERE guid=?",
+                        (guid,))
+            row = cur.fetchone()
+            if not row:
+                return None
+
+            attempts = (row[0] or 0) + 1
+            if attempts >= max_attempts:
+                state, next_attempt_at = FAILED, None
+            else:
+                state = PENDING
+                next_attempt_at = now + utils.backoff_delay(
+                    attempts, base_delay=base_delay, max_delay=max_delay)
+            cur.execute("UPDATE remote_movies SET state=?, queued=0, "
+                        "complete=0, lease_owner=NULL, lease_expires=NULL, "
+                        "attempts=?, next_attempt_at=?, last_error=?, "
+                        "updated_at=? WHERE guid=?",
+                        (state, attempts, next_attempt_at, error, now, guid))
+
+        if state == FAILED and self._known_movies is not None:
+            self._forget([guid])
+
+        return next_attempt_at
+
+    def defer(self, guids, next_attempt_at):
+        """Return movies to pending without counting an attempt, to be
+        claimed again no earlier than next_attempt_at.
+        """
+        now = time.time()
+        with self._connections.transaction() as cur:
+            cur.executemany("UPDATE remote_movies SET state=?, queued=0, "
+                            "complete=0, lease_owner=NULL, "
+                            "lease_expires=NULL, next_attempt_at=?, "
+                            "updated_at=? WHERE guid=?",
+                            ((PENDING, next_attempt_at, now, guid)
+                             for guid in guids))
+
+    def heartbeat(self, worker_id, guids, lease_seconds=300):
+        """Extend worker_id's leases on guids.
+        Returns:
+            - int: number of leases still held by worker_id
+        """
+        guids = list(guids)
+        if not guids:
+            return 0
+
+        placeholders = ", ".join("?" for _ in guids)
+        statement = f"UPDATE remote_movies SET lease_expires=? " \
+                    f"WHERE lease_owner=? AND state IN (?, ?) " \
+                    f"AND guid IN ({placeholders})"
+        params = (time.time() + lease_seconds, worker_id,
+                  QUEUED, IN_PROGRESS, *guids)
+
+        return self._execute_sql(statement, params)
+
+    def release(self, worker_id):
+        """Return every unfinished movie leased to worker_id to the pool.
+        Returns:
+            - list(str): guids that were released
+        """
+        with self._connections.transaction(immediate=True) as cur:
+            cur.execute("SELECT guid FROM remote_movies WHERE lease_owner=? "
+                        "AND state IN (?, ?)",
+                        (worker_id, QUEUED, IN_PROGRESS))
+            guids = [row[0] for row in cur.fetchall()]
+            cur.execute("UPDATE remote_movies SET state=?, queued=0, "
+                        "complete=0, lease_owner=NULL, lease_expires=NULL, "
+                        "updated_at=? WHERE lease_owner=? AND state IN (?, ?)",
+                        (PENDING, time.time(), worker_id,
+                         QUEUED, IN_PROGRESS))
+
+        return guids
+
+    def start_transfer(self, guid, source, destination=None,
+                       remote_host=None, worker_id=None):
+        """Record the start of a transfer attempt.
+        Returns:
+            - int: id of the new transfers row
+        """
+        statement = "INSERT INTO transfers (guid, worker_id, remote_host, " \
+                    "source, destination, started_at) " \
+                    "VALUES (?, ?, ?, ?, ?, ?)"
+        params = (guid, worker_id, remote_host, source, destination,
+                  time.time())
+        with self._connections.transaction() as cur:
+            cur.execute(statement, params)
+
+        return cur.lastrowid
+
+    def finish_transfer(self, transfer_id, success, bytes_transferred=0,
+                        mean_bps=None, peak_bps=None, retries=0,
+                        failure_reason=None, destination=None):
+        statement = "UPDATE transfers SET ended_at=?, success=?, bytes=?, " \
+                    "mean_bps=?, peak_bps=?, retries=?, failure_reason=?, " \
+                    "destination=COALESCE(?, destination) WHERE id=?"
+        params = (time.time(), int(bool(success)), bytes_transferred,
+                  mean_bps, peak_bps, retries, failure_reason, destination,
+                  transfer_id)
+        self._execute_sql(statement, params)
+
+    def select_transfers(self, guid):
+        statement = "SELECT * FROM transfers WHERE guid=? " \
+                    "ORDER BY started_at"
+        return self._query(statement, (guid,)).fetchall()
+
+    def throughput_percentiles(self, group_by="day", since=None,
+                               percentiles=(50, 90, 99)):
+        """Report mean-throughput percentiles of successful transfers,
+        grouped by UTC day or by remote host.
+        Requires:
+            - str(group_by): "day" or "host"
+        Optional:
+            - float(since): only transfers started after this epoch time
+            - percentiles to report
+        Returns:
+            - list of dicts: group, count, bytes and one p<N> key per
+              percentile, in bytes per second
+        """
+        groups = {
+            "day": "date(started_at, 'unixepoch')",
+            "host": "COALESCE(remote_host, '')",
+        }
+        if group_by not in groups:
+            raise ValueError(f"Invalid group_by: {group_by}")
+
+        statement = f"SELECT {groups[group_by]} AS grp, mean_bps, bytes " \
+                    f"FROM transfers WHERE success=1 " \
+                    f"AND mean_bps IS NOT NULL AND started_at>=? " \
+                    f"ORDER BY grp, mean_bps"
+        rates = {}
+        total_bytes = {}
+        for row in self._query(statement, (since or 0,)):
+            rates.setdefault(row[0], []).append(row[1])
+            total_bytes[row[0]] = total_bytes.get(row[0], 0) + row[2]
+
+        report = []
+        for group, values in rates.items():
+            entry = {
+                "group": group,
+                "count": len(values),
+                "bytes": total_bytes[group],
+            }
+            for pct in percentiles:
+                entry[f"p{pct}"] = utils.percentile(values, pct)
+            report.append(entry)
+
+        return report
+
+    def snapshot_watermark(self, server):
+        """Return the newest updatedAt stored for server's library, or None
+        if it has never been fetched.
+        """
+        row = self._query("SELECT updated_at FROM library_watermarks "
+                          "WHERE server=?", (server,)).fetchone()
+
+        return row[0] if row else None
+
+    def snapshot_count(self, server):
+        return self._query("SELECT COUNT(*) FROM library_snapshot "
+                           "WHERE server=?", (server,)).fetchone()[0]
+
+    def apply_snapshot(self, server, items):
+        """Upsert a batch of library items for server in one transaction
+        and advance its watermark to the newest updated_at seen.
+        Requires:
+            - iterable of tuple(rating_key, guid, title, year, files,
+              resolution, updated_at), files already serialized
+        Returns:
+            - int: number of items applied
+        """
+        items = list(items)
+        newest = self.snapshot_watermark(server)
+        for item in items:
+            if item[6] is not None and (newest is None or item[6] > newest):
+                newest = item[6]
+
+        with self._connections.transaction(immediate=True) as cur:
+            cur.executemany("INSERT OR REPLACE INTO library_snapshot "
+                            "(server, rating_key, guid, title, year, files, "
+                            "resolution, updated_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            ((server, *item) for item in items))
+            cur.execute("INSERT OR REPLACE INTO library_watermarks "
+                        "(server, updated_at, refreshed_at) "
+                        "VALUES (?, ?, ?)", (server, newest, time.time()))
+
+        return len(items)
+
+    def clear_snapshot(self, server):
+        """Drop server's stored library and watermark, so the next fetch
+        is a full one.
+        """
+        with self._connections.transaction() as cur:
+            cur.execute("DELETE FROM library_snapshot WHERE server=?",
+                        (server,))
+            cur.execute("DELETE FROM library_watermarks WHERE server=?",
+                        (server,))
+
+    def iter_snapshot(self, server):
+        """Yield the stored library rows for server without loading them
+        all at once.
+        """
+        yield from self._query("SELECT * FROM library_snapshot "
+                               "WHERE server=?", (server,))
+
+    def enqueue_slack(self, webhook_url, payload, max_messages=None):
+        """Persist an outbound Slack message. Once more than max_messages
+        are waiting, the oldest are dropped.
+        Returns:
+            - tuple(int(message id), int(messages dropped))
+        """
+        dropped = 0
+        with self._connections.transaction(immediate=True) as cur:
+            cur.execute("INSERT INTO slack_outbox (webhook_url, payload, "
+                        "created_at) VALUES (?, ?, ?)",
+                        (webhook_url, payload, time.time()))
+            message_id = cur.lastrowid
+            if max_messages:
+                cur.execute("DELETE FROM slack_outbox WHERE id<=?",
+                            (message_id - max_messages,))
+                dropped = cur.rowcount
+
+        return message_id, dropped
+
+    def claim_slack(self, limit=20, lease_seconds=60):
+        """Lease up to limit Slack messages that are due, oldest first. A
+        claimed message is not handed out again until lease_seconds have
+        passed, so a sender that dies mid-delivery only delays it.
+        Returns:
+            - list of slack_outbox rows
+        """
+        now = time.time()
+        with self._connections.transaction(immediate=True) as cur:
+            cur.execute("SELECT * FROM slack_outbox "
+                        "WHERE next_attempt_at IS NULL OR next_attempt_at<=? "
+                        "ORDER BY id LIMIT ?", (now, limit))
+            rows = cur.fetchall()
+            if rows:
+                ids = [row['id'] for row in rows]
+                placeholders = ", ".join("?" for _ in ids)
+                cur.execute(f"UPDATE slack_outbox SET next_attempt_at=? "
+                            f"WHERE id IN ({placeholders})",
+                            (now + lease_seconds, *ids))
+
+        return rows
+
+    def retry_slack(self, message_id, next_attempt_at, error=None,
+                    attempt=True):
+        """Schedule a Slack message for another send. attempt=False defers
+        it without counting towards its attempts, e.g. while rate limited.
+        """
+        self._execute_sql("UPDATE slack_outbox SET attempts=attempts+?, "
+                          "next_attempt_at=?, "
+                          "last_error=COALESCE(?, last_error) WHERE id=?",
+                          (int(attempt), next_attempt_at, error, message_id))
+
+    def delete_slack(self, message_id):
+        self._execute_sql("DELETE FROM slack_outbox WHERE id=?",
+                          (message_id,))
+
+    def count_slack(self):
+        return self._query(
+            "SELECT COUNT(*) FROM slack_outbox").fetchone()[0]
+
+    def remove_many(self, guids):
+        guids = list(guids)
+        if self._known_movies is not None:
+            self._forget(guids)
+        with self._connections.transaction() as cur:
+            cur.executemany(_remove_guid_statement,
+                            ((guid,) for guid in guids))
 
     def remove_guid(self, guid):
-        self._execute_sql(_remove_guid_statement, (guid,))
+        self.remove_many([guid])
+
+    def insert_sync_request(self, request_id, remote_path, guid=None):
+        now = time.time()
+        statement = "INSERT INTO sync_requests " \
+                    "(request_id, guid, remote_path, state, " \
+                    "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)"
+        self._execute_sql(
+            statement,
+            (request_id, guid, remote_path, PENDING_RESOLUTION, now, now))
+
+    def select_sync_request(self, request_id):
+        statement = "SELECT * FROM sync_requests WHERE request_id=?"
+        return self._query(statement, (request_id,)).fetchone()
+
+    def select_pending_sync_requests(self, stale_after=300):
+        """Return ids of requests still waiting for resolution, including
+        requests stuck in resolving for longer than stale_after seconds,
+        e.g. because the process resolving them died.
+        """
+        statement = "SELECT request_id FROM sync_requests " \
+                    "WHERE state=? OR (state=? AND updated_at<?) " \
+                    "ORDER BY created_at"
+        params = (PENDING_RESOLUTION, RESOLVING, time.time() - stale_after)
+        return [r[0] for r in self._query(statement, params)]
+
+    def claim_sync_request(self, request_id, stale_after=300):
+        """Mark a request as resolving unless another worker already has it.
+        Returns:
+            - bool: True if this caller now owns the request
+        """
+        now = time.time()
+        statement = "UPDATE sync_requests SET state=?, updated_at=? " \
+                    "WHERE request_id=? AND " \
+                    "(state=? OR (state=? AND updated_at<?))"
+        params = (RESOLVING, now, request_id,
+                  PENDING_RESOLUTION, RESOLVING, now - stale_after)
+        return self._execute_sql(statement, params) == 1
+
+    def update_sync_request(self, request_id, state, status=None,
+                            status_code=None, guid=None):
+        statement = "UPDATE sync_requests SET state=?, status=?, " \
+                    "status_code=?, guid=COALESCE(?, guid), updated_at=? " \
+                    "WHERE request_id=?"
+        params = (state, status, status_code, guid, time.time(), request_id)
+        self._execute_sql(statement, params)
+
+
+_spool_schema = """
+create table if not exists sync_spool (
+    id integer primary key autoincrement,
+    guid text,
+    path text not null,
+    host text,
+    attempts integer default 0,
+    next_attempt_at real,
+    last_error text,
+    created_at real not null
+);
+create unique index if not exists sync_spool_path
+    on sync_spool (path);
+create unique index if not exists sync_spool_guid
+    on sync_spool (guid) where guid is not null;
+create index if not exists sync_spool_ready
+    on sync_spool (next_attempt_at);
+"""
+
+
+class SyncSpool(object):
+    """Client-side spool of sync requests waiting to be sent to the
+    listener. It lives in its own small database on the client, apart
+    from the server's transfer database.
+    Requires:
+        - str(db_path)
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._connections = ConnectionManager(db_path)
+        self._connections.get().executescript(_spool_schema)
+
+    def close(self):
+        self._connections.close()
+
+    def add_many(self, items):
+        """Add sync requests to the spool. A request whose path, or guid,
+        is already spooled is ignored.
+        Requires:
+            - iterable of tuple(guid, path, host), guid and host may be None
+        Returns:
+            - list(int): ids of the requests added
+        """
+        now = time.time()
+        added = []
+        with self._connections.transaction(immediate=True) as cur:
+            for guid, path, host in items:
+                cur.execute("INSERT OR IGNORE INTO sync_spool "
+                            "(guid, path, host, created_at) "
+                            "VALUES (?, ?, ?, ?) RETURNING id",
+                            (guid, path, host, now))
+                added.extend(row[0] for row in cur.fetchall())
+
+        return added
+
+    def claim(self, limit=200, lease_seconds=120, force=False, after_id=0):
+        """Lease up to limit spooled requests with an id above after_id,
+        oldest first. Requests waiting on a retry are skipped unless force
+        is set.
+        Returns:
+            - list of sync_spool rows
+        """
+        now = time.time()
+        condition = "" if force else \
+            "AND (next_attempt_at IS NULL OR next_attempt_at<=?) "
+        params = (after_id, limit) if force else (after_id, now, limit)
+        with self._connections.transaction(immediate=True) as cur:
+            cur.execute(f"SELECT * FROM sync_spool WHERE id>? {condition}"
+                        f"ORDER BY id LIMIT ?", params)
+            rows = cur.fetchall()
+            if rows:
+                ids = [row['id'] for row in rows]
+                placeholders = ", ".join("?" for _ in ids)
+                cur.execute(f"UPDATE sync_spool SET next_attempt_at=? "
+                            f"WHERE id IN ({placeholders})",
+                            (now + lease_seconds, *ids))
+
+        return rows
+
+    def retry(self, spool_id, next_attempt_at, error=None):
+        with self._connections.transaction() as cur:
+            cur.execute("UPDATE sync_spool SET attempts=attempts+1, "
+                        "next_attempt_at=?, last_error=? WHERE id=?",
+                        (next_attempt_at, error, spool_id))
+
+    def delete(self, spool_ids):
+        spool_ids = list(spool_ids)
+        with self._connections.transaction() as cur:
+            for i in range(0, len(spool_ids), _max_variables):
+                chunk = spool_ids[i:i + _max_variables]
+                placeholders = ", ".join("?" for _ in chunk)
+                cur.execute(f"DELETE FROM sync_spool "
+                            f"WHERE id IN ({placeholders})", chunk)
+
+    def count(self):
+        return self._connections.get().execute(
+            "SELECT COUNT(*) FROM sync_spool").fetchone()[0]
+
+    def next_attempt(self):
+        """Epoch time the next spooled request is due, or None if the
+        spool is empty. Requests not yet tried are due now.
+        """
+        return self._connections.get().execute(
+            "SELECT MIN(COALESCE(next_attempt_at, 0)) "
+            "FROM sync_spool").fetchone()[0]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import itertools
+import threading
+import time
+from collections import deque
+
+from utilities import config
+
+# event types
+MOVIE_STATE = "movie_state"
+TRANSFER_START = "transfer_start"
+TRANSFER_PROGRESS = "transfer_progress"
+TRANSFER_COMPLETE = "transfer_complete"
+
+
+class Subscription(object):
+    """Bounded buffer of events for one subscriber. When the buffer is full
+    the oldest event is discarded, so a slow consumer never blocks the
+    publisher. The number of discarded events is kept in dropped.
+    """
+
+    def __init__(self, buffer_size=256):
+        self._events = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, event):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrived within timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._events, timeout):
+                return None
+            return self._events.popleft()
+
+
+class EventBroadcaster(object):
+    """Fans events out to any number of in-memory subscribers."""
+
+    def __init__(self, buffer_size=256):
+        self.buffer_size = buffer_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self, buffer_size=None):
+        subscription = Subscription(buffer_size or self.buffer_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event_type, **data):
+        if not self._subscribers:
+            return None
+
+        event = {
+            "id": next(self._ids),
+            "type": event_type,
+            "time": time.time(),
+            "data": data,
+        }
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+        return event
+
+
+class ProgressThrottle(object):
+    """Lets a progress update through at most once per interval seconds.
+    The final update (complete == total) is always let through.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._last = 0
+
+    def ready(self, complete, total):
+        now = time.monotonic()
+        if complete < total and now - self._last < self.interval:
+            return False
+        self._last = now
+
+        return True
+
+
+broadcaster = EventBroadcaster(buffer_size=config.EVENT_BUFFER_SIZE)
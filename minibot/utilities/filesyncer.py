@@ -3,24 +3,30 @@ import os
 import math
 import time
 import signal
+import socket
+import threading
+import uuid
+from queue import Empty
 from queue import Queue
 
-import pysftp
-
 from utilities import config
 from utilities import db
+from utilities import dbutils
+from utilities import events
 from utilities import logger
+from utilities import metrics
 from utilities import omdb
 from utilities import plexutils
+from utilities import slackoutbox
+from utilities import tracing
 from utilities import utils
 from utilities.plexutils import PlexException
+from utilities.slackutils import SlackException
+from utilities.slackutils import SlackProgressMessage
 from utilities.slackutils import SlackSender
 from utilities.utils import retry
 from utilities.utils import SigInt
-
-
-signal.signal(signal.SIGINT, utils.interrupt_handler)
-signal.signal(signal.SIGTERM, utils.interrupt_handler)
+from utilities.utils import StoppableThread
 
 
 def notify_slack(message, title=None, channel="me", debug=False):
@@ -42,13 +48,39 @@ def notify_slack(message, title=None, channel="me", debug=False):
         debug=debug
     )
     notification.set_simple_message(message=message, title=title)
-    notification.send()
+    if not config.SLACK_OUTBOX:
+        try:
+            notification.send()
+        except utils.CircuitOpenError as e:
+            logger.warning(f"Skipping Slack notification: {str(e)}")
+        return
+
+    try:
+        payload = notification.build_payload()
+    except SlackException as e:
+        logger.error(f"Skipping Slack notification: {str(e)}")
+        return
+    slackoutbox.get_outbox().enqueue(webhook_url, payload)
+
+
+def _progress_text(complete, total, width=20):
+    """Format transfer progress as a text bar, e.g.
+    ▓▓▓▓▓▓▓▓░░░░░░░░░░░░ 40% [1.2 GB / 3.0 GB]
+    """
+    filled = int(width * complete / total) if total else 0
+    pct = math.floor(100 * complete / total) if total else 0
+
+    return f"{'▓' * filled}{'░' * (width - filled)} {pct}% " \
+           f"[{utils.convert_file_size(complete)} / " \
+           f"{utils.convert_file_size(total)}]"
 
 
 class FileSyncer(object):
     def __init__(self, remote_file=None,
-                 destination=config.FILE_TRANSFER_COMPLETE_DIR):
-        self.remote_server = config.REMOTE_FILE_SERVER
+                 destination=config.FILE_TRANSFER_COMPLETE_DIR,
+                 progress_callback=None, guid=None, remote_server=None):
+        self.guid = guid
+        self.remote_server = remote_server or config.REMOTE_FILE_SERVER
         self.remote_user = config.REMOTE_USER
 
         self.remote_file = remote_file
@@ -61,6 +93,10 @@ class FileSyncer(object):
 
         self.transfer_successful = False
         self.max_concurrent_transfers = 1
+        self.attempts = 0
+        self.bytes_transferred = 0
+        self.peak_rate = None
+        self.failure_reason = None
 
         self._local_prv_key = os.path.expanduser(
             os.path.join("~/.ssh", "id_rsa"))
@@ -70,6 +106,9 @@ class FileSyncer(object):
         self._transfer_end_time = None
         self._prev_completed_bytes = 0
         self._prev_progress_time = None
+        self._progress_callback = progress_callback
+        self._progress_throttle = events.ProgressThrottle(
+            config.EVENT_PROGRESS_INTERVAL)
 
     def _set_file_paths(self, remote_file=None):
         if remote_file:
@@ -85,6 +124,7 @@ class FileSyncer(object):
 
         return self.remote_file
 
+    @utils.log_context(component="file_syncer")
     def get_remote_file(self):
         success = False
         if not self.remote_file:
@@ -99,18 +139,53 @@ class FileSyncer(object):
             try:
                 success = self._transfer_file()
             except Exception as e:
-                logger.error(f"Transfer failed after 3 attempts: {e}")
-                pass
+                logger.error(f"Transfer failed: {e}")
+                self.failure_reason = str(e)
 
             if success:
-                self._move_file_to_destination()
+                if not self._move_file_to_destination():
+                    self.failure_reason = "Failed to move file to " \
+                                          "destination"
+            elif not self.failure_reason:
+                self.failure_reason = "Transfer incomplete"
+
+        if self.transfer_successful and self.final_file_path:
+            metrics.TRANSFERS.inc(result="success")
+        else:
+            metrics.TRANSFERS.inc(result="failure")
+        events.broadcaster.publish(
+            events.TRANSFER_COMPLETE, guid=self.guid,
+            success=bool(self.transfer_successful and self.final_file_path),
+            path=self.final_file_path)
 
         return self.transfer_successful, self.final_file_path
 
-    @utils.retry(attempts=3, delay=10, logger=logger)
+    @property
+    def source(self):
+        return f"{self.remote_user}@{self.remote_server}:{self.remote_file}"
+
+    @property
+    def mean_rate(self):
+        """Mean transfer rate in bytes per second of the last attempt."""
+        if not self._transfer_start_time or not self._transfer_end_time:
+            return None
+        duration = self._transfer_end_time - self._transfer_start_time
+        if duration <= 0:
+            return None
+
+        return self.bytes_transferred / duration
+
+    @tracing.traced("sftp.transfer")
     def _transfer_file(self):
         logger.info("Starting file transfer...")
         self.transfer_successful = False
+        self.attempts += 1
+        self._seen_progress = []
+        self._transfer_end_time = None
+        self._prev_completed_bytes = 0
+        self._prev_progress_time = None
+        import pysftp
+
         try:
             self._in_progress_file = os.path.join(
                 self._tmp_dir, "IN_PROGRESS-" + self.filename)
@@ -118,6 +193,9 @@ class FileSyncer(object):
                                    username=self.remote_user,
                                    private_key=self._local_prv_key) as sftp:
                 self._transfer_start_time = time.time()
+                events.broadcaster.publish(
+                    events.TRANSFER_START, guid=self.guid,
+                    remote_file=self.remote_file, filename=self.filename)
                 sftp.get(self.remote_file, self._in_progress_file,
                          callback=self._transfer_progress)
 
@@ -129,6 +207,7 @@ class FileSyncer(object):
 
         return self.transfer_successful
 
+    @tracing.traced("file.move")
     def _move_file_to_destination(self):
         """
         Move file from in progress directory into its final destination
@@ -177,7 +256,8 @@ class FileSyncer(object):
     def _transfer_progress(self, complete, total, step=1):
         """
         Calculate and log the percent of the file that has been transferred
-        as well as the transfer rate.
+        as well as the transfer rate. Each logged step is also reported to
+        the progress_callback, if one was given.
         :param complete: (int) bytes transferred
         :param total: (int) total bytes
         :param step: (int) what percentages to log. example: step of 5 would
@@ -185,6 +265,13 @@ class FileSyncer(object):
         :return:
         """
         pct = math.floor(100 * complete / total)
+        self.bytes_transferred = complete
+        if self._progress_throttle.ready(complete, total):
+            events.broadcaster.publish(
+                events.TRANSFER_PROGRESS, guid=self.guid,
+                filename=self.filename, bytes_transferred=complete,
+                total_bytes=total, percent=round(100 * complete / total, 1))
+
         c = utils.convert_file_size(complete)
         t = utils.convert_file_size(total)
 
@@ -198,9 +285,13 @@ class FileSyncer(object):
             duration = abs(
                 self._transfer_end_time - self._transfer_start_time)
             rate = utils.convert_file_size(total / duration)
+            metrics.TRANSFER_BYTES.inc(total)
+            metrics.TRANSFER_DURATION.observe(duration)
+            metrics.TRANSFER_THROUGHPUT.observe(total / duration)
             logger.info(f"Transfer completed in "
                         f"{round(duration, 2)} seconds [{rate}/s]")
             self._seen_progress.append(pct)
+            self._report_progress(complete, total)
             return
 
         # log each N percentage exactly once where in is step
@@ -209,8 +300,18 @@ class FileSyncer(object):
             logger.info(f"Transfer Progress: "
                         f"{self.filename}\t{pct}%  \t[ {c} / {t} ]\t{rate}/s")
             self._seen_progress.append(pct)
+            self._report_progress(complete, total)
+            return
+
+    def _report_progress(self, complete, total):
+        if not self._progress_callback:
             return
 
+        try:
+            self._progress_callback(complete, total)
+        except Exception as e:
+            logger.warning(f"Progress callback failed: {str(e)}")
+
     def _transfer_rate(self, complete):
         """
         Return the transfer rate in bytes per second based on the number of
@@ -225,6 +326,8 @@ class FileSyncer(object):
         byte_progress = abs(complete - self._prev_completed_bytes)
         time_progress = abs(now - self._prev_progress_time)
         transfer_rate = (byte_progress / time_progress)
+        if self.peak_rate is None or transfer_rate > self.peak_rate:
+            self.peak_rate = transfer_rate
 
         self._prev_progress_time = now
         self._prev_completed_bytes = complete
@@ -234,17 +337,23 @@ class FileSyncer(object):
 
 class PlexSyncer(object):
     def __init__(self, imdb_guid=None, remote_path=None,
-                 debug=False, **kwargs):
+                 debug=False, worker_id=None, previous_attempts=0,
+                 remote_host=None, **kwargs):
         self.kwargs = kwargs
         self.debug = debug
+        self.remote_host = remote_host
+        self.worker_id = worker_id
+        self.previous_attempts = previous_attempts
+        self.retryable = True
+        self.failure_reason = None
         self.imdb_guid = imdb_guid
         self.remote_path = remote_path
         self.title_year = None
         self.movie_dir = os.path.expanduser(config.FILE_TRANSFER_COMPLETE_DIR)
         self.plex_local = None
         self._omdb = omdb.OMDb(api_key=config.OMDB_API_KEY, debug=debug)
+        self._progress_message = None
 
-    @utils.retry(delay=30, exception_to_check=plexutils.PlexException)
     def connect_plex(self):
         logger.info("Connecting to Plex")
         self.plex_local = plexutils.PlexSearch(
@@ -260,7 +369,11 @@ class PlexSyncer(object):
         if not imdb_guid:
             imdb_guid = self.imdb_guid
 
-        result, status_code = self._omdb.search(imdb_guid=imdb_guid)
+        try:
+            result, status_code = self._omdb.search(imdb_guid=imdb_guid)
+        except utils.CircuitOpenError as e:
+            logger.warning(f"Skipping OMDb lookup: {str(e)}")
+            return None
 
         logger.debug(f"Response from OMDb: [{status_code}] {result}")
         if not status_code == 200:
@@ -277,6 +390,40 @@ class PlexSyncer(object):
 
         return title_year
 
+    def _update_progress(self, complete, total):
+        db.update_progress(self.imdb_guid, complete, total)
+        if self._progress_message:
+            self._progress_message.update(
+                _progress_text(complete, total),
+                title=f"Transferring: {self.title_year}", color="blue")
+
+    def _start_progress_message(self):
+        """Post a live progress message for this transfer, if enabled."""
+        if not config.SLACK_PROGRESS_UPDATES or not config.SLACK_BOT_TOKEN:
+            return
+
+        self._progress_message = SlackProgressMessage(
+            config.SLACK_BOT_TOKEN, config.SLACK_PROGRESS_CHANNEL,
+            interval=config.SLACK_PROGRESS_INTERVAL)
+        self._progress_message.update(
+            f"Starting transfer from {self.remote_host or 'remote server'}",
+            title=f"Transferring: {self.title_year}", color="blue")
+
+    def _finish_progress_message(self, success, file_path=None):
+        if not self._progress_message:
+            return
+
+        if success:
+            self._progress_message.finish(
+                str(file_path), title=f"Download complete: "
+                                      f"{self.title_year}", color="good")
+        else:
+            self._progress_message.finish(
+                f"{self.failure_reason or 'Unknown error'}",
+                title=f"Transfer failed: {self.title_year}", color="danger")
+        self._progress_message = None
+
+    @utils.log_context(component="plex_syncer")
     def run_sync_flow(self):
         self.connect_plex()
         self.title_year = self.get_title_year()
@@ -288,8 +435,15 @@ class PlexSyncer(object):
 
             syncer = FileSyncer(
                 remote_file=self.remote_path,
-                destination=self.movie_dir)
-
+                destination=self.movie_dir,
+                progress_callback=self._update_progress,
+                guid=self.imdb_guid,
+                remote_server=self.remote_host)
+
+            self._start_progress_message()
+            transfer_id = db.start_transfer(
+                self.imdb_guid, syncer.source, destination=self.movie_dir,
+                remote_host=syncer.remote_server, worker_id=self.worker_id)
             file_path = None
             try:
                 success, file_path = syncer.get_remote_file()
@@ -297,7 +451,12 @@ class PlexSyncer(object):
                 logger.warning(
                     f"Skipping item due to exception: "
                     f"{self.imdb_guid} \n{str(e)}")
+                syncer.failure_reason = str(e)
                 success = False
+            self._record_transfer(transfer_id, syncer,
+                                  bool(success and file_path))
+            self.failure_reason = syncer.failure_reason
+            self._finish_progress_message(success and file_path, file_path)
 
             if not file_path or not success:
                 t = f"Transfer failed: {self.title_year}"
@@ -309,64 +468,242 @@ class PlexSyncer(object):
             notify_slack(message, title=t, debug=self.debug)
         else:
             success = False
+            self.retryable = False
 
             logger.info(f"Movie already in library: [{self.imdb_guid}]"
                         f"{self.title_year}\n{self.remote_path}")
 
         return success
 
+    def _record_transfer(self, transfer_id, syncer, success):
+        try:
+            db.finish_transfer(
+                transfer_id, success,
+                bytes_transferred=syncer.bytes_transferred,
+                mean_bps=syncer.mean_rate if success else None,
+                peak_bps=syncer.peak_rate,
+                retries=self.previous_attempts,
+                failure_reason=None if success else syncer.failure_reason,
+                destination=syncer.final_file_path)
+        except Exception as e:
+            logger.warning(f"Failed to record transfer history: {str(e)}")
+
 
 class TransferQueue(object):
-    def __init__(self, database, *args, **kwargs):
+    """Claims movies from the database under a lease and transfers them one
+    at a time. Leases are renewed by a heartbeat thread while they are held,
+    so any number of queues, on this or other machines, can share one
+    database; rows held by a worker that dies return to the pool once their
+    lease expires.
+    """
+
+    def __init__(self, database, *args, worker_id=None, **kwargs):
         self.queue = Queue()
         self.db = database
+        self.worker_id = worker_id or f"{socket.gethostname()}:" \
+                                      f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = config.TRANSFER_LEASE_SECONDS
+        self.claim_batch = config.TRANSFER_CLAIM_BATCH
+        self._enqueued = set()
+        self._enqueued_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Ask run() to return once the current item is finished."""
+        self._stop_event.set()
+        self._wake.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    @staticmethod
+    def _publish_state(guid, state):
+        events.broadcaster.publish(events.MOVIE_STATE, guid=guid, state=state)
 
     def _worker(self):
-        while not self.queue.empty():
+        while not self.queue.empty() and not self.stopped():
             logger.info("Queued items: {}".format(self.queue.unfinished_tasks))
             q_guid = self.queue.get()
-            logger.info(f"Starting download: {q_guid}")
-            queued_movie = self.db.select_guid(q_guid)
-            syncer = PlexSyncer(
-                imdb_guid=q_guid,
-                remote_path=queued_movie[db.rempath_col]
-            )
-            successful = syncer.run_sync_flow()
-            if successful:
-                self.db.mark_complete(q_guid)
-                logger.info(f"Completed download: {q_guid}")
-            else:
-                self.db.remove_guid(q_guid)
-                logger.error(f"Failed download: {q_guid}")
+            plex_breaker = utils.circuit_breaker("plex")
+            if not plex_breaker.available():
+                self._defer(q_guid, plex_breaker.name,
+                            plex_breaker.retry_after)
+                continue
 
+            queued_movie = self.db.select_guid(q_guid)
+            with utils.log_context(
+                    correlation_id=queued_movie['correlation_id'],
+                    component="transfer_queue"), \
+                    tracing.span("sync_item", guid=q_guid):
+                finished = self._sync_item(q_guid, queued_movie)
+            if not finished:
+                continue
+
+            with self._enqueued_lock:
+                self._enqueued.discard(q_guid)
             self.queue.task_done()
 
         return
 
+    def _sync_item(self, q_guid, queued_movie):
+        """Transfer one claimed movie and record the outcome.
+        Returns:
+            - bool: False if the item was deferred and handed back already
+        """
+        logger.info(f"Starting download: {q_guid}")
+        self.db.mark_in_progress(q_guid)
+        self._publish_state(q_guid, dbutils.IN_PROGRESS)
+        syncer = PlexSyncer(
+            imdb_guid=q_guid,
+            remote_path=queued_movie[db.rempath_col],
+            worker_id=self.worker_id,
+            previous_attempts=queued_movie['attempts'] or 0,
+            remote_host=queued_movie['remote_host']
+        )
+        try:
+            successful = syncer.run_sync_flow()
+        except SigInt:
+            raise
+        except utils.CircuitOpenError as e:
+            self._defer(q_guid, e.name, e.retry_after)
+            return False
+        except Exception as e:
+            logger.error(f"Sync flow failed: {q_guid} \n{str(e)}")
+            syncer.failure_reason = str(e)
+            successful = False
+
+        if successful:
+            self.db.mark_complete(q_guid)
+            self._publish_state(q_guid, dbutils.COMPLETE)
+            logger.info(f"Completed download: {q_guid}")
+        elif syncer.retryable:
+            self._retry_later(q_guid, syncer.failure_reason)
+        else:
+            self.db.mark_failed(q_guid)
+            self._publish_state(q_guid, dbutils.FAILED)
+            logger.error(f"Failed download: {q_guid}")
+
+        return True
+
+    def _defer(self, guid, dependency, delay):
+        """Hand an item back without counting an attempt because a
+        dependency it needs has an open circuit.
+        """
+        logger.warning(f"{dependency} unavailable, deferring for "
+                       f"{round(delay)} seconds: {guid}")
+        self.db.defer([guid], time.time() + delay)
+        self._publish_state(guid, dbutils.PENDING)
+        with self._enqueued_lock:
+            self._enqueued.discard(guid)
+        self.queue.task_done()
+
+    def _retry_later(self, guid, error=None):
+        """Put a failed item back in the database with a backoff delay
+        instead of retrying it here, so the worker moves straight on to the
+        next ready item. Gives up after TRANSFER_MAX_ATTEMPTS attempts.
+        """
+        next_attempt_at = self.db.schedule_retry(
+            guid, config.TRANSFER_MAX_ATTEMPTS,
+            base_delay=config.TRANSFER_RETRY_BASE_DELAY,
+            max_delay=config.TRANSFER_RETRY_MAX_DELAY, error=error)
+        if next_attempt_at is None:
+            self._publish_state(guid, dbutils.FAILED)
+            logger.error(f"Failed download, giving up: {guid}")
+            return
+
+        self._publish_state(guid, dbutils.PENDING)
+        delay = round(next_attempt_at - time.time())
+        logger.warning(f"Failed download, retrying in {delay} seconds: "
+                       f"{guid}")
+
     def add_item(self, guid, **kwargs):
+        self.add_items([guid], **kwargs)
+
+    def add_items(self, guids, **kwargs):
+        """Claim and queue guids for transfer in one database transaction.
+        Safe to call from other threads, e.g. the server handing off new
+        requests; guids already queued here or leased by another worker
+        are ignored.
+        """
+        with self._enqueued_lock:
+            wanted = [g for g in dict.fromkeys(guids)
+                      if g not in self._enqueued]
+            if not wanted:
+                return
+            claimed = self.db.claim_guids(self.worker_id, wanted,
+                                          lease_seconds=self.lease_seconds)
+            self._enqueued.update(claimed)
+
+        skipped = set(wanted) - set(claimed)
+        if skipped and logger.is_enabled("DEBUG"):
+            logger.debug(f"Not claimable, skipping: {sorted(skipped)}")
+        for guid in claimed:
+            self._enqueue(guid, **kwargs)
+
+    def _enqueue(self, guid, **kwargs):
         logger.debug(f"Enqueuing: {guid}")
         self.queue.put(guid, **kwargs)
-        self.db.mark_queued(guid)
+        self._publish_state(guid, dbutils.QUEUED)
+        self._wake.set()
+
+    def _claim(self):
+        rows = self.db.claim(self.worker_id, limit=self.claim_batch,
+                             lease_seconds=self.lease_seconds)
+        for row in rows:
+            with self._enqueued_lock:
+                self._enqueued.add(row[db.guid_col])
+            self._enqueue(row[db.guid_col])
+
+        return rows
+
+    def _heartbeat(self):
+        thread = threading.current_thread()
+        while not thread.wait(self.lease_seconds / 3):
+            with self._enqueued_lock:
+                held = list(self._enqueued)
+            if not held:
+                continue
+            try:
+                renewed = self.db.heartbeat(
+                    self.worker_id, held, lease_seconds=self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"Lease heartbeat failed: {str(e)}")
+                continue
+            if renewed < len(held):
+                logger.warning(f"Lost {len(held) - renewed} of {len(held)} "
+                               f"leases: {self.worker_id}")
 
-    @retry(exception_to_check=PlexException,
-           delay=30, logger=logger)
     def run(self, update_frequency=5):
         """ Instantiate the TransferQueue using the supplied database, then
         continuously check for unqueued items in the database, add them to the
         queue, and empty the queue.
         :param update_frequency: How frequently in seconds to check the db
-            for items. (defaults to 5 seconds)
+            for items. Items passed to add_item wake the queue immediately.
+            (defaults to 5 seconds)
         :return:
         """
         u = None
+        heartbeat = StoppableThread(target=self._heartbeat,
+                                    name="lease-heartbeat", daemon=True)
+        heartbeat.start()
+        logger.debug(f"Queue worker id: {self.worker_id}")
         try:
-            while True:
-                unqueued = self.db.select_all_unqueued_movies()
-                for u in unqueued:
-                    self.add_item(u[db.guid_col])
+            while not self.stopped():
+                self._wake.clear()
+                plex_breaker = utils.circuit_breaker("plex")
+                if not plex_breaker.available():
+                    self._wake.wait(min(update_frequency,
+                                        plex_breaker.retry_after))
+                    continue
+
+                if self.queue.empty():
+                    claimed = self._claim()
+                    if claimed:
+                        u = claimed[-1]
 
                 if self.queue.empty():
-                    time.sleep(update_frequency)
+                    self._wake.wait(update_frequency)
                 else:
                     self._worker()
 
@@ -388,24 +725,112 @@ class TransferQueue(object):
 
         finally:
             logger.debug("Cleaning up...")
+            heartbeat.stop()
             self._cleanup()
             logger.debug("Exiting queue: clean")
             return
 
     def _cleanup(self):
         logger.debug("Cleaning up")
-        incomplete_rows = self.db.select_all_queued_incomplete()
-        for i in incomplete_rows:
-            logger.debug(
-                f"Setting incomplete: guid: {i[db.guid_col]}: row: {i}")
-            self.db.mark_unqueued_incomplete(i[db.guid_col])
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except Empty:
+                break
+        with self._enqueued_lock:
+            self._enqueued.clear()
+
+        for guid in self.db.release(self.worker_id):
+            logger.debug(f"Setting incomplete: guid: {guid}")
+            self._publish_state(guid, dbutils.PENDING)
+
+
+class TransferService(object):
+    """Runs a TransferQueue in a supervised background thread, e.g. inside
+    the server process. The queue is restarted with exponential backoff if
+    it exits while the service is still running.
+    """
+
+    def __init__(self, database, update_frequency=60,
+                 restart_delay=5, max_restart_delay=300):
+        self.transfer_queue = TransferQueue(database)
+        self.update_frequency = update_frequency
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self._thread = None
+
+    @property
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def start(self):
+        if self.running:
+            return self
+        self._thread = StoppableThread(
+            target=self._supervise, name="transfer-service", daemon=True)
+        self._thread.start()
+        logger.info("Transfer service started")
+
+        return self
+
+    def stop(self, timeout=30):
+        if not self._thread:
+            return
+        logger.info("Stopping transfer service")
+        self._thread.stop()
+        self.transfer_queue.stop()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"Transfer service still busy after {timeout} "
+                           f"seconds; leaving it to exit with the process")
+        self._thread = None
+        slackoutbox.stop_outbox()
+
+    def submit(self, guid):
+        """Hand a newly inserted guid straight to the queue."""
+        self.submit_many([guid])
+
+    def submit_many(self, guids):
+        if self.running:
+            self.transfer_queue.add_items(guids)
+
+    def _supervise(self):
+        thread = threading.current_thread()
+        delay = self.restart_delay
+        while not thread.stopped():
+            started = time.monotonic()
+            try:
+                self.transfer_queue.run(
+                    update_frequency=self.update_frequency)
+            except Exception as e:
+                logger.error(f"Transfer queue crashed: {str(e)}")
+
+            if thread.stopped():
+                break
+
+            if time.monotonic() - started > self.max_restart_delay:
+                delay = self.restart_delay
+            logger.warning(f"Transfer queue exited unexpectedly. "
+                           f"Restarting in {delay} seconds")
+            if thread.wait(delay):
+                break
+            delay = min(delay * 2, self.max_restart_delay)
+
+        logger.info("Transfer service stopped")
 
 
 @retry(delay=3, logger=logger)
 def run_file_syncer():
+    signal.signal(signal.SIGINT, utils.interrupt_handler)
+    signal.signal(signal.SIGTERM, utils.interrupt_handler)
+
     logger.debug(f"db exists?: {os.path.exists(db.db_path)} | {db.db_path}")
     q = TransferQueue(db)
 
     logger.debug("Starting queue")
-    q.run()
+    try:
+        q.run()
+    finally:
+        slackoutbox.stop_outbox()
     logger.info("Transfer queue stopped")
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Process-local counters, gauges and histograms rendered in the Prometheus
+text exposition format. Updates are sharded per thread and take no lock.
+"""
+import contextlib
+import threading
+import time
+import weakref
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+
+def _format_labels(label_names, key, extra=None):
+    pairs = list(zip(label_names, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f"{name}=\"{value}\"")
+
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Metric(object):
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._samples())
+
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class _ShardedMetric(_Metric):
+    """Base for metrics whose values are kept in per-thread shards. Shards
+    of threads that have exited are folded into a retired shard so the
+    list does not grow with every short-lived thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = {}
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {}
+            with self._lock:
+                self._shards.append(
+                    (weakref.ref(threading.current_thread()), shard))
+            self._local.shard = shard
+            return shard
+
+    def _merged(self):
+        merged = {}
+        with self._lock:
+            alive = []
+            for thread_ref, shard in self._shards:
+                thread = thread_ref()
+                if thread is None or not thread.is_alive():
+                    self._merge_into(self._retired, dict(shard))
+                else:
+                    alive.append((thread_ref, shard))
+            self._shards = alive
+            self._merge_into(merged, self._retired)
+            for _, shard in alive:
+                self._merge_into(merged, dict(shard))
+
+        return merged
+
+    def _merge_into(self, target, shard):
+        raise NotImplementedError
+
+
+class Counter(_ShardedMetric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge_into(self, target, shard):
+        for key, value in shard.items():
+            target[key] = target.get(key, 0) + value
+
+    def _samples(self):
+        for key, value in sorted(self._merged().items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} " \
+                  f"{value}"
+
+
+class Histogram(_ShardedMetric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=_DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        state = shard.get(key)
+        if state is None:
+            state = shard[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _merge_into(self, target, shard):
+        for key, (counts, total, count) in shard.items():
+            state = target.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    def _samples(self):
+        for key, (counts, total, count) in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    self.label_names, key, ("le", repr(float(bound))))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, key, ("le", "+Inf"))
+            yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Gauge(_Metric):
+    """Gauge whose values are either set directly or collected from a
+    callback at render time. The callback returns a dict of
+    {tuple(label values): value}.
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+        self._collect = None
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, func):
+        self._collect = func
+
+    def _samples(self):
+        values = dict(self._values)
+        if self._collect:
+            try:
+                values.update(self._collect())
+            except Exception:
+                pass
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} " \
+                  f"{value}"
+
+
+def render():
+    """Return all registered metrics in the Prometheus text format."""
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def dependency_call(dependency, operation):
+    """Time a call to an external dependency and count it as an error if
+    it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        DEPENDENCY_ERRORS.inc(dependency=dependency, operation=operation)
+        raise
+    finally:
+        DEPENDENCY_LATENCY.observe(time.perf_counter() - start,
+                                   dependency=dependency,
+                                   operation=operation)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_LATENCY = Histogram(
+    "minibot_http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ("endpoint", "method", "status"))
+DEPENDENCY_LATENCY = Histogram(
+    "minibot_dependency_call_duration_seconds",
+    "Latency of calls to OMDb, Plex and Slack",
+    ("dependency", "operation"))
+DEPENDENCY_ERRORS = Counter(
+    "minibot_dependency_errors_total",
+    "Failed calls to OMDb, Plex and Slack",
+    ("dependency", "operation"))
+QUEUE_ITEMS = Gauge(
+    "minibot_queue_items",
+    "Items in the transfer queue database by state",
+    ("state",))
+TRANSFERS = Counter(
+    "minibot_transfers_total",
+    "Finished file transfers by result",
+    ("result",))
+TRANSFER_BYTES = Counter(
+    "minibot_transfer_bytes_total",
+    "Bytes received by completed file transfers")
+TRANSFER_DURATION = Histogram(
+    "minibot_transfer_duration_seconds",
+    "Wall time of completed file transfers",
+    buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400))
+TRANSFER_THROUGHPUT = Histogram(
+    "minibot_transfer_throughput_bytes_per_second",
+    "Mean throughput of completed file transfers",
+    buckets=tuple(2 ** i * 1024 * 128 for i in range(12)))
+CIRCUIT_OPEN = Gauge(
+    "minibot_circuit_open",
+    "1 while the circuit breaker for a dependency is open",
+    ("dependency",))
+RETRIES = Counter(
+    "minibot_retries_total",
+    "Retries performed by utils.retry",
+    ("function",))
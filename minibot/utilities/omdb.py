@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 import json
+import threading
+import time
 
 import requests
 
 from utilities import constants
+from utilities import metrics
+from utilities import tracing
+from utilities import utils
 
 
 class OMDb(object):
-    def __init__(self, api_key=None, short_plot=True, debug=False):
+    """Searches OMDb for movie details.
+    Optional kwargs:
+        - session (requests.Session): reuse one connection pool for calls
+        - cache_ttl (int): seconds to keep successful results in memory
+    """
+
+    def __init__(self, api_key=None, short_plot=True, debug=False,
+                 session=None, cache_ttl=0):
         self.api_key = api_key
         self.debug = debug
         self.short_plot = short_plot
+        self.session = session
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._cache_lock = threading.Lock()
 
     @property
     def _plot_detail(self):
@@ -19,7 +35,15 @@ class OMDb(object):
         else:
             return constants.PLOT_LONG
 
+    @tracing.traced("omdb.search")
     def search(self, imdb_guid=None, title=None, year=None):
+        cache_key = (imdb_guid, title, year, self.short_plot)
+        if self.cache_ttl:
+            with self._cache_lock:
+                cached = self._cache.get(cache_key)
+            if cached and cached[0] > time.monotonic():
+                return cached[1], 200
+
         if self.debug:
             print("Searching OMDb... guid: [{}] title: [{}] year: [{}]".format(
                 imdb_guid, title, year))
@@ -36,10 +60,23 @@ class OMDb(object):
             print(f"url: {constants.OMDB_URL}")
             print(f"query: {query_dict}")
 
-        response = requests.get(
-            constants.OMDB_URL, params=query_dict,
-            headers={"Content-Type": "application/json"}
-        )
+        with utils.circuit_breaker("omdb").guard() as mark_failed:
+            with metrics.dependency_call("omdb", "search"):
+                response = (self.session or requests).get(
+                    constants.OMDB_URL, params=query_dict,
+                    headers={"Content-Type": "application/json"}
+                )
+            if response.status_code >= 500:
+                mark_failed()
+        if response.status_code != 200:
+            metrics.DEPENDENCY_ERRORS.inc(
+                dependency="omdb", operation="search")
+
+        result = json.loads(response.text)
+        if self.cache_ttl and response.status_code == 200 and \
+                result.get("Response") != "False":
+            with self._cache_lock:
+                self._cache[cache_key] = (
+                    time.monotonic() + self.cache_ttl, result)
 
-        return json.loads(
-            response.text, encoding="unicode"), response.status_code
+        return result, response.status_code
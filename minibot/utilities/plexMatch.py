@@ -1,33 +1,34 @@
 #!/usr/bin/env python3
-import os.path
-import pickle
-import time
+import json
 import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import ConnectTimeout
+from utilities import client
 from utilities import config
-from utilities import server
+from utilities import db
 from utilities import plexutils
-from plexapi.server import PlexServer
 
-movies_file_cbs = os.path.abspath("movies_cbs.pickle")
-movies_file_srs = os.path.abspath("movies_srs.pickle")
-processed_movies_file = os.path.abspath("processed_movies.pickle")
+# kinds of library change yielded by diff_libraries
+ADDED = "added"
+REMOVED = "removed"
+PATH_CHANGED = "path_changed"
 
+Movie = namedtuple("Movie", ("guid", "title", "year", "files",
+                             "rating_key", "updated_at", "resolution"),
+                   defaults=(None, None, None))
+Change = namedtuple("Change", ("kind", "guid", "old", "new"))
 
-def save_pickle(data, pickle_file):
-    with open(pickle_file, "wb") as f:
-        pickle.dump(data, f)
+# source selection, see find_missing
+BY_RESOLUTION = "resolution"
+BY_THROUGHPUT = "throughput"
+_resolution_ranks = {"4k": 4, "1080": 3, "720": 2, "480": 1}
 
 
-def load_pickle(pickle_file):
-    if os.path.exists(pickle_file):
-        with open(pickle_file, "rb") as f:
-            return pickle.load(f)
-    print(f"FAILED TO LOAD PICKLE: {pickle_file}")
-    return
+def connect(server):
+    from plexapi.server import PlexServer
 
-
-def get_plex_data(server):
     print("connecting to {} ...".format(server))
     try:
         plex = PlexServer(server, config.PLEX_TOKEN)
@@ -37,40 +38,245 @@ def get_plex_data(server):
 
     print(f"connected: {plex.friendlyName} - {plex.machineIdentifier}")
 
-    all_movies = []
-    for m in plex.library.section("Movies").all():
-        title = m.title
-        year = m.year
-        guid = plexutils.get_clean_imdb_guid(m.guid)
-        files = m.locations
-        m_info = (guid, title, year, files)
-        all_movies.append(m_info)
+    return plex
+
+
+def _movie(video):
+    updated_at = video.updatedAt.timestamp() if video.updatedAt else None
+    resolution = None
+    if video.media:
+        resolution = video.media[0].videoResolution
+
+    return Movie(plexutils.get_clean_imdb_guid(video.guid), video.title,
+                 video.year, tuple(video.locations), str(video.ratingKey),
+                 updated_at, resolution)
+
+
+def iter_plex_pages(plex, page_size=None, updated_since=None):
+    """Stream the Movies section one page at a time using the container
+    start/size parameters, instead of loading the whole section at once.
+    Items come oldest update first, so a partial fetch never skips past
+    anything older than the newest item stored.
+    Optional:
+        - int(page_size): defaults to config.PLEX_PAGE_SIZE
+        - float(updated_since): only items updated at or after this time
+    Yields:
+        - list of Movie
+    """
+    page_size = page_size or config.PLEX_PAGE_SIZE
+    section = plex.library.section("Movies")
+    key = f"/library/sections/{section.key}/all?sort=updatedAt:asc"
+    if updated_since is not None:
+        # Plex's >>= is strictly greater than, so step back a second to
+        # include items updated in the watermark's own second. Refetched
+        # items are upserted again, which is harmless.
+        key += f"&updatedAt>>={int(updated_since) - 1}"
+
+    start = 0
+    while True:
+        page = section.fetchItems(
+            key, container_start=start, container_size=page_size)
+        yield [_movie(m) for m in page]
+        if len(page) < page_size:
+            return
+        start += page_size
+
+
+def iter_plex_movies(plex, page_size=None, updated_since=None):
+    for page in iter_plex_pages(plex, page_size=page_size,
+                                updated_since=updated_since):
+        yield from page
+
+
+def library_size(plex):
+    section = plex.library.section("Movies")
+    data = plex.query(f"/library/sections/{section.key}/all",
+                      params={"X-Plex-Container-Start": 0,
+                              "X-Plex-Container-Size": 0})
+
+    return int(data.attrib.get("totalSize") or data.attrib.get("size") or 0)
 
-    print(f"{server} total: {len(all_movies)}")
 
-    if len(all_movies) > 0:
-        return all_movies
-    else:
+def _fetch_into_snapshot(server, plex, updated_since=None):
+    fetched = 0
+    for page in iter_plex_pages(plex, updated_since=updated_since):
+        fetched += db.apply_snapshot(
+            server, ((m.rating_key, m.guid, m.title, m.year,
+                      json.dumps(m.files), m.resolution, m.updated_at)
+                     for m in page))
+
+    return fetched
+
+
+def refresh_snapshot(server, plex=None):
+    """Bring the stored snapshot of a server's library up to date. Only
+    items updated since the server's watermark are fetched. Deletions do
+    not show up in that delta, so if the stored count then disagrees with
+    the library the snapshot is rebuilt from a full fetch.
+    Returns:
+        - int: number of items fetched
+    """
+    plex = plex or connect(server)
+    watermark = db.snapshot_watermark(server)
+    fetched = _fetch_into_snapshot(server, plex, updated_since=watermark)
+
+    total = library_size(plex)
+    if watermark is not None and db.snapshot_count(server) != total:
+        print(f"{server}: snapshot out of date, fetching full library")
+        db.clear_snapshot(server)
+        fetched = _fetch_into_snapshot(server, plex)
+
+    print(f"{server} total: {total} | fetched: {fetched}")
+
+    return fetched
+
+
+def snapshot_movies(server):
+    """Stream a server's stored library snapshot.
+    Yields:
+        - Movie
+    """
+    for row in db.iter_snapshot(server):
+        yield Movie(row['guid'], row['title'], row['year'],
+                    tuple(json.loads(row['files'] or "[]")),
+                    row['rating_key'], row['updated_at'], row['resolution'])
+
+
+def _refresh_or_keep(server):
+    from plexapi.server import PlexServer
+
+    try:
+        return refresh_snapshot(
+            server, plex=PlexServer(server, config.PLEX_TOKEN))
+    except Exception as e:
+        print(f" * ERROR: {server} unavailable, using stored snapshot"
+              f"\n{str(e)}")
         return None
 
 
-def compare_saved_plex_data(movies_original, movies_new):
-    guids_original = []
-    for m in movies_original:
-        if m[0]:
-            guids_original.append(m[0])
+def refresh_snapshots(servers):
+    """Refresh the snapshots of several servers concurrently. A server that
+    cannot be reached keeps its previous snapshot, which is only safe to
+    use for a source; see main.
+    Returns:
+        - dict {server: int(items fetched) or None if unreachable}
+    """
+    servers = list(dict.fromkeys(servers))
+    with ThreadPoolExecutor(max_workers=len(servers) or 1) as pool:
+        fetched = pool.map(_refresh_or_keep, servers)
 
-    unique_movies = []
+    return dict(zip(servers, fetched))
+
+
+def _resolution_rank(resolution):
+    return _resolution_ranks.get(str(resolution).lower(), 0)
+
+
+def _host_throughput(days=30):
+    """Median throughput of recent transfers by SFTP host, from the local
+    transfer history.
+    """
+    since = time.time() - days * 86400
+    return {g['group']: g['p50'] for g in
+            db.throughput_percentiles(group_by="host", since=since)}
+
+
+def find_missing(target, sources, prefer=BY_RESOLUTION):
+    """Find the movies any source has that target does not, in one pass
+    over the stored snapshots, and pick one source for each.
+    Requires:
+        - str(target): our Plex server
+        - dict {plex server url: sftp host or None} of sources
+    Optional:
+        - prefer: BY_RESOLUTION picks the highest resolution copy, using
+          throughput to break ties; BY_THROUGHPUT picks the source host
+          with the best recent median throughput, then resolution
+    Returns:
+        - list of tuple(source, Movie)
+    """
+    have = {m.guid for m in snapshot_movies(target) if m.guid}
+    blacklist = frozenset(config.blacklist)
+    rates = _host_throughput()
+
+    best = {}
+    for source, host in sources.items():
+        rate = rates.get(host or config.REMOTE_FILE_SERVER) or 0
+        for m in snapshot_movies(source):
+            if not m.guid or not m.files or m.guid in have or \
+                    m.guid in blacklist:
+                continue
+
+            resolution = _resolution_rank(m.resolution)
+            if prefer == BY_THROUGHPUT:
+                score = (rate, resolution)
+            else:
+                score = (resolution, rate)
+            current = best.get(m.guid)
+            if current is None or score > current[0]:
+                best[m.guid] = (score, source, m)
+
+    return [(source, m) for _, source, m in best.values()]
+
+
+def index_movies(movies):
+    """Key movies by guid, skipping any without one.
+    Returns:
+        - dict {guid: Movie}
+    """
+    return {m[0]: Movie(*m) for m in movies or () if m[0]}
+
+
+def diff_libraries(movies_original, movies_new):
+    """Compare two libraries by guid. movies_new is consumed lazily, so it
+    can be a stream straight from iter_plex_movies; additions and path
+    changes are yielded as they are seen and removals at the end.
+    Requires:
+        - movies_original: dict from index_movies, or iterable of movies
+        - movies_new: iterable of movies
+    Yields:
+        - Change(kind, guid, old, new)
+    """
+    if not isinstance(movies_original, dict):
+        movies_original = index_movies(movies_original)
+
+    seen = set()
     for m in movies_new:
-        if m[0] and m[0] not in guids_original and m[0] not in config.blacklist:
-            unique_movies.append(m)
+        guid = m[0]
+        if not guid or guid in seen:
+            continue
+        seen.add(guid)
+
+        old = movies_original.get(guid)
+        if old is None:
+            yield Change(ADDED, guid, None, Movie(*m))
+        elif set(old.files) != set(m[3]):
+            yield Change(PATH_CHANGED, guid, old, Movie(*m))
+
+    for guid in movies_original.keys() - seen:
+        yield Change(REMOVED, guid, movies_original[guid], None)
+
+
+def compare_saved_plex_data(movies_original, movies_new):
+    blacklist = frozenset(config.blacklist)
+    unique_movies = []
+    for change in diff_libraries(movies_original, movies_new):
+        if change.kind == ADDED and change.guid not in blacklist:
+            unique_movies.append(change.new)
 
     return unique_movies
 
 
-def sync(unique):
+def sync(unique, hosts=None):
+    """Send bulk sync requests for movies.
+    Requires:
+        - list of Movie
+    Optional:
+        - dict {guid: sftp host} for movies not on REMOTE_FILE_SERVER
+    """
+    hosts = hosts or {}
     try:
         print(f"unique: {len(unique)}")
+        requests_to_send = []
         for u in unique:
             guid = u[0]
             titleyear = str(f"{u[1]} ({u[2]})")
@@ -78,32 +284,42 @@ def sync(unique):
             print(f"{titleyear} - {u}")
 
             if titleyear and guid and filepath:
-                print(f"\tSending sync request: {titleyear} [{guid}]"
+                print(f"\tQueueing sync request: {titleyear} [{guid}]"
                       f" - [{filepath}]")
-                server.post_new_movie_to_syncer(path=filepath, imdb_guid=guid)
-                time.sleep(2)
+                sync_request = {"path": filepath, "guid": guid}
+                if hosts.get(guid):
+                    sync_request["host"] = hosts[guid]
+                requests_to_send.append(sync_request)
             else:
                 print(f" * ERROR: missing data: {u}")
 
+        results = client.post_new_movies_to_syncer(requests_to_send)
+        print(f"sent: {len(requests_to_send)} | "
+              f"accepted: {sum(1 for r in results if r['code'] == 200)}")
+
     except Exception as e:
         raise e
 
 
 def main():
-    # get movie data from servers and cache locally
-    cbs_movies = get_plex_data(config.PLEX_SERVER_URL_CBS)
-    if cbs_movies:
-        save_pickle(cbs_movies, movies_file_cbs)
-
-    srs_movies = get_plex_data(config.PLEX_SERVER_URL)
-    if srs_movies:
-        save_pickle(srs_movies, movies_file_srs)
-
-    # load cached data and sync unique items
-    movies_srs = load_pickle(movies_file_srs)
-    movies_cbs = load_pickle(movies_file_cbs)
-    unique = compare_saved_plex_data(movies_srs, movies_cbs)
-    sync(unique)
+    sources = config.PLEX_SOURCE_SERVERS or {config.PLEX_SERVER_URL_CBS: None}
+
+    # bring the local library snapshots up to date, then sync unique items
+    fetched = refresh_snapshots([config.PLEX_SERVER_URL, *sources])
+    if fetched[config.PLEX_SERVER_URL] is None:
+        # a missing or stale snapshot of our own library would make
+        # everything on the sources look missing
+        print(f" * ERROR: {config.PLEX_SERVER_URL} unavailable, "
+              f"not syncing")
+        return
+    missing = find_missing(config.PLEX_SERVER_URL, sources,
+                           prefer=config.PLEX_SOURCE_SELECTION)
+    for source in sources:
+        print(f"{source}: {sum(1 for s, _ in missing if s == source)} "
+              f"selected")
+
+    sync([m for _, m in missing],
+         hosts={m.guid: sources[s] for s, m in missing if sources[s]})
 
 
 if __name__ == "__main__":
@@ -2,12 +2,11 @@
 import os.path
 import re
 
-from plexapi.myplex import MyPlexAccount
-from plexapi.server import PlexServer
-
 from utilities import config
 from utilities import logger
+from utilities import metrics
 from utilities import omdb
+from utilities import tracing
 from utilities import utils
 from utilities.slackutils import SlackSender, text_color
 
@@ -32,6 +31,7 @@ class PlexSearch(object):
         self.plex_server = server
         self.plex = None
 
+    @tracing.traced("plex.connect")
     def connect(self, auth_type=None):
         """
         Uses PlexAPI to instantiate a Plex server connection
@@ -41,14 +41,17 @@ class PlexSearch(object):
 
         logger.debug(f"Connecting to Plex: {auth_type}")
 
-        if auth_type == "user":
-            plex = self._plex_account()
-        elif auth_type == "token":
-            plex = self._plex_token()
-        else:
+        if auth_type not in ("user", "token"):
             raise PlexException(
                 f"Invalid Plex connection type: {self.auth_type}")
 
+        with utils.circuit_breaker("plex").guard(), \
+                metrics.dependency_call("plex", "connect"):
+            if auth_type == "user":
+                plex = self._plex_account()
+            else:
+                plex = self._plex_token()
+
         self.plex = plex
         logger.debug(f"Connected: {self.plex_server}")
 
@@ -61,6 +64,8 @@ class PlexSearch(object):
             - IMDb guid of a movie to search for
         Returns MyPlexAccount object
         """
+        from plexapi.myplex import MyPlexAccount
+
         if not config.PLEX_USERNAME or not config.PLEX_PASSWORD:
             raise PlexException(f"Plex username or password missing "
                                 f"from config.py: {self.auth_type}")
@@ -82,6 +87,8 @@ class PlexSearch(object):
             - IMDb guid of a movie to search for
         Returns PlexServer object
         """
+        from plexapi.server import PlexServer
+
         if not config.PLEX_SERVER_URL or not config.PLEX_TOKEN:
             raise PlexException(
                 f"Plex token or url config.py: {self.auth_type}")
@@ -95,6 +102,7 @@ class PlexSearch(object):
 
         return plex
 
+    @tracing.traced("plex.movie_search")
     def movie_search(self, guid=None, title=None, year=None):
         """Uses PlexAPI to search for a movie via IMDb guid,
         title, and/or year.
@@ -118,13 +126,15 @@ class PlexSearch(object):
         if self.debug:
             logger.debug(f"Searching Plex: {guid}")
 
-        if guid:
-            for m in movies.search(guid=guid):
-                found_movies.append(m)
-        if title:
-            for m in movies.search(title=title, year=year):
-                if m not in found_movies:
+        with utils.circuit_breaker("plex").guard(), \
+                metrics.dependency_call("plex", "movie_search"):
+            if guid:
+                for m in movies.search(guid=guid):
                     found_movies.append(m)
+            if title:
+                for m in movies.search(title=title, year=year):
+                    if m not in found_movies:
+                        found_movies.append(m)
 
         return found_movies
 
@@ -154,14 +164,26 @@ class MovieNotification(object):
     info about a given movie and formatting a json notification for Slack.
     """
 
-    def __init__(self, debug=False, **kwargs):
+    def __init__(self, debug=False, session=None, omdb_cache_ttl=0,
+                 **kwargs):
         self.debug = debug
         self.imdb_guid = None
         self.color = text_color("purple")
         self._plex_helper = PlexSearch(**kwargs)
         self._plex_result = None
         self._omdb_result = None
-        self._omdb = omdb.OMDb(api_key=config.OMDB_API_KEY, debug=debug)
+        self._omdb = omdb.OMDb(api_key=config.OMDB_API_KEY, debug=debug,
+                               session=session, cache_ttl=omdb_cache_ttl)
+
+    def connect(self):
+        """Connect to Plex now rather than on the first search."""
+        self._plex_helper.connect()
+
+    def reset(self):
+        """Drop the kept Plex connection, e.g. after a failure left it
+        stale. The next search connects again.
+        """
+        self._plex_helper.plex = None
 
     def search(self, imdb_guid):
         """Searches Plex via PlexAPI and OMDb for a movie using an IMDb guid.
@@ -231,16 +253,23 @@ def get_new_movie_json(imdb_guid, **kwargs):
     return movie_data
 
 
-def send_new_movie_slack_notification(args):
+def send_new_movie_slack_notification(args, notifier=None, session=None):
     """Send a rich movie notification to Slack using supplied arguments.
     Requires:
         - str(imdb_guid)
+    Optional:
+        - MovieNotification(notifier): reuse its Plex connection and OMDb
+          cache instead of connecting from scratch
+        - requests.Session(session): send to Slack over a kept-alive session
     """
-    movie_json = get_new_movie_json(
-        imdb_guid=args.imdb_guid,
-        debug=args.debug,
-        auth_type=config.PLEX_AUTH_TYPE
-    )
+    if notifier:
+        movie_json = notifier.search(args.imdb_guid)
+    else:
+        movie_json = get_new_movie_json(
+            imdb_guid=args.imdb_guid,
+            debug=args.debug,
+            auth_type=config.PLEX_AUTH_TYPE
+        )
     logger.debug(movie_json)
 
     channel = config.DEFAULT_SLACK_ROOM
@@ -254,7 +283,8 @@ def send_new_movie_slack_notification(args):
         user=config.DEFAULT_SLACK_USER,
         json_attachments=movie_json,
         debug=args.debug,
-        dryrun=args.dryrun
+        dryrun=args.dryrun,
+        session=session
     )
 
     slack.send()
@@ -331,6 +361,19 @@ def get_clean_imdb_guid(guid):
     return clean_guid
 
 
+def is_imdb_guid(guid):
+    """Checks whether a string is a bare IMDb guid, e.g. tt0168122.
+    Requires:
+        - str(guid)
+    Returns:
+        - bool
+    """
+    if not isinstance(guid, str):
+        return False
+
+    return bool(re.fullmatch(r"[A-Za-z]{2}[\d]{5,8}", guid))
+
+
 def get_title_year_from_path(movie_path):
     """Example string:
         IN: /mnt/movies/D/Defending Your Life (1991).mp4
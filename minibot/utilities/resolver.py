@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import threading
+from queue import Empty
+from queue import Queue
+
+from utilities import dbutils
+from utilities import logger
+from utilities import utils
+from utilities.utils import StoppableThread
+
+
+class RequestResolver(object):
+    """Pool of background threads that resolve sync requests accepted by
+    the asynchronous intake. Each request is claimed in the database before
+    it is resolved, so several server processes can share the same pending
+    requests without resolving one twice.
+    Requires:
+        - database: FileTransferDB holding the sync_requests table
+        - resolve_func: callable taking a raw request dict and returning
+          tuple(dict(request_data), int(status_code))
+    """
+
+    def __init__(self, database, resolve_func, workers=2):
+        self.db = database
+        self.resolve_func = resolve_func
+        self.workers = workers
+        self.queue = Queue()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads and pick up any requests left pending
+        by a previous run.
+        """
+        for i in range(self.workers):
+            t = StoppableThread(target=self._run, name=f"resolver-{i}",
+                                daemon=True)
+            self._threads.append(t)
+            t.start()
+
+        for request_id in self.db.select_pending_sync_requests():
+            logger.debug(f"Recovering pending sync request: {request_id}")
+            self.submit(request_id)
+
+        return self
+
+    def stop(self, timeout=None):
+        for t in self._threads:
+            t.stop()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def submit(self, request_id):
+        self.queue.put(request_id)
+
+    def _run(self):
+        while not threading.current_thread().stopped():
+            try:
+                request_id = self.queue.get(timeout=1)
+            except Empty:
+                continue
+
+            try:
+                with utils.log_context(correlation_id=request_id,
+                                       component="resolver"):
+                    self._resolve(request_id)
+            except Exception as e:
+                logger.error(f"Failed to resolve sync request: "
+                             f"{request_id} \n{str(e)}")
+                self.db.update_sync_request(
+                    request_id, dbutils.FAILED,
+                    status=f"Unknown exception: {str(e)}", status_code=500)
+            finally:
+                self.queue.task_done()
+
+    def _resolve(self, request_id):
+        if not self.db.claim_sync_request(request_id):
+            logger.debug(f"Sync request already claimed: {request_id}")
+            return
+
+        row = self.db.select_sync_request(request_id)
+        raw_request = {
+            "path": row["remote_path"],
+            "guid": row["guid"],
+        }
+        logger.info(f"Resolving sync request: {request_id} - {raw_request}")
+
+        r, status_code = self.resolve_func(raw_request)
+        if status_code == 200:
+            state = dbutils.RESOLVED
+        elif status_code == 208:
+            state = dbutils.DUPLICATE
+        else:
+            state = dbutils.FAILED
+
+        self.db.update_sync_request(
+            request_id, state, status=r['status'],
+            status_code=status_code, guid=r['guid'])
+        logger.info(f"Resolved sync request: {request_id} - {state} "
+                    f"[{status_code}]")
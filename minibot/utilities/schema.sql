@@ -3,5 +3,97 @@ create table if not exists remote_movies (
     guid text unique not null,
     remote_path text not null,
     queued integer default 0,
-    complete integer default 0
+    complete integer default 0,
+    state text not null default 'pending',
+    bytes_transferred integer default 0,
+    total_bytes integer,
+    updated_at real default 0,
+    lease_owner text,
+    lease_expires real,
+    attempts integer default 0,
+    next_attempt_at real,
+    last_error text,
+    remote_host text,
+    correlation_id text
 );
+
+create index if not exists remote_movies_state
+    on remote_movies (state, id);
+
+create index if not exists remote_movies_path
+    on remote_movies (remote_path);
+
+create index if not exists remote_movies_lease
+    on remote_movies (state, lease_expires);
+
+create index if not exists remote_movies_retry
+    on remote_movies (state, next_attempt_at);
+
+create table if not exists sync_requests (
+    request_id text primary key,
+    guid text,
+    remote_path text not null,
+    state text not null default 'pending_resolution',
+    status text,
+    status_code integer,
+    created_at real not null,
+    updated_at real not null
+);
+
+create index if not exists sync_requests_state
+    on sync_requests (state, updated_at);
+
+create table if not exists transfers (
+    id integer primary key autoincrement,
+    guid text not null,
+    worker_id text,
+    remote_host text,
+    source text not null,
+    destination text,
+    started_at real not null,
+    ended_at real,
+    bytes integer default 0,
+    mean_bps real,
+    peak_bps real,
+    retries integer default 0,
+    success integer,
+    failure_reason text
+);
+
+create index if not exists transfers_guid
+    on transfers (guid, started_at);
+
+create index if not exists transfers_started
+    on transfers (started_at);
+
+create table if not exists library_snapshot (
+    server text not null,
+    rating_key text not null,
+    guid text,
+    title text,
+    year integer,
+    files text,
+    resolution text,
+    updated_at real,
+    primary key (server, rating_key)
+) without rowid;
+
+create index if not exists library_snapshot_guid
+    on library_snapshot (guid);
+
+create table if not exists library_watermarks (
+    server text primary key,
+    updated_at real,
+    refreshed_at real
+);
+create table if not exists slack_outbox (
+    id integer primary key autoincrement,
+    webhook_url text not null,
+    payload text not null,
+    attempts integer default 0,
+    next_attempt_at real,
+    last_error text,
+    created_at real not null
+);
+create index if not exists slack_outbox_ready
+    on slack_outbox (next_attempt_at);
@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
+import atexit
+import hashlib
 import json
 import os.path
 import sqlite3
+import threading
+import time
+import uuid
 
 from flask import Flask
+from flask import g
 from flask import request
 
 from utilities import config
 from utilities import db
+from utilities import dbutils
+from utilities import events
 from utilities import logger
+from utilities import metrics
 from utilities import omdb
 from utilities import plexutils
+from utilities import resolver
+from utilities import utils
 
 app = Flask(__name__)
 
+metrics.QUEUE_ITEMS.set_function(
+    lambda: {(state,): count for state, count in db.count_by_state().items()})
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+
+@app.after_request
+def _observe_request_latency(response):
+    start = g.get("request_start_time")
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.REQUEST_LATENCY.observe(
+            time.perf_counter() - start, endpoint=endpoint,
+            method=request.method, status=response.status_code)
+
+    return response
+
+
+@app.route(config.METRICS_ENDPOINT, methods=['GET'])
+def metrics_endpoint():
+    return app.response_class(response=metrics.render(), status=200,
+                              content_type=metrics.CONTENT_TYPE)
+
 
 @app.route("/", methods=['GET'])
 def hello_world():
@@ -58,17 +95,22 @@ def handle_movie_sync_request(raw_request, debug=False):
 
     _omdb = omdb.OMDb(api_key=config.OMDB_API_KEY, debug=debug)
 
-    if raw_request['guid']:
-        imdb_guid = raw_request['guid']
-        result, omdb_status = _omdb.search(imdb_guid=imdb_guid)
-    else:
-        clean_path = os.path.basename(request_data['path'])
-
-        t, y = plexutils.get_title_year_from_path(clean_path)
-        request_data['title'] = t
-        request_data['year'] = y
-        result, omdb_status = _omdb.search(
-            title=request_data['title'], year=request_data['year'])
+    try:
+        if raw_request['guid']:
+            imdb_guid = raw_request['guid']
+            result, omdb_status = _omdb.search(imdb_guid=imdb_guid)
+        else:
+            clean_path = os.path.basename(request_data['path'])
+
+            t, y = plexutils.get_title_year_from_path(clean_path)
+            request_data['title'] = t
+            request_data['year'] = y
+            result, omdb_status = _omdb.search(
+                title=request_data['title'], year=request_data['year'])
+    except utils.CircuitOpenError as e:
+        request_data['status'] = f"OMDb unavailable: {str(e)} | " \
+                                 f"{raw_request}"
+        return request_data, 503
 
     if not omdb_status == 200:
         request_data['status'] = f"Error locating movie in OMDB: {raw_request}"
@@ -119,21 +161,40 @@ def handle_movie_sync_request(raw_request, debug=False):
     return request_data, 200
 
 
-@app.route(config.NEW_MOVIE_ENDPOINT, methods=['POST'])
-def sync_new_movie():
-    debug = False
-    raw_request = request.get_json()
-    logger.info(f"Request: {raw_request}", stdout=True)
+def queue_movie_sync_request(raw_request, debug=False):
+    """Resolve a sync request via OMDb and insert it into the transfer
+    queue database.
+    Returns:
+        - tuple(dict(request_data), int(status_code))
+    """
+    if raw_request and db.is_requested(guid=raw_request.get('guid'),
+                                       remote_path=raw_request.get('path')):
+        logger.warning(f"Skipping request. Already in database: "
+                       f"{raw_request}")
+        r = {
+            "title": None,
+            "year": None,
+            "guid": raw_request.get('guid'),
+            "path": raw_request.get('path'),
+            "status": "Item already requested",
+        }
+        return r, 208
 
     r, status_code = handle_movie_sync_request(raw_request, debug=debug)
-    logger.debug(f"Result: {r} - [{status_code}]")
+    if logger.is_enabled("DEBUG"):
+        logger.debug(f"Result: {r} - [{status_code}]")
 
     if status_code == 200:
         try:
             if debug:
                 logger.debug(f"Inserting into db: "
                              f"{r['guid']} / {r['path']} \n{r}")
-            db.insert(guid=r['guid'], remote_path=r['path'])
+            db.insert(guid=r['guid'], remote_path=r['path'],
+                      correlation_id=utils.correlation_id())
+            events.broadcaster.publish(
+                events.MOVIE_STATE, guid=r['guid'], path=r['path'],
+                state=dbutils.PENDING)
+            _hand_off(r['guid'])
         except sqlite3.IntegrityError as e:
             logger.error(e)
             logger.warning(f"Skipping request. Already in database: "
@@ -147,9 +208,419 @@ def sync_new_movie():
     else:
         logger.warning(f"{status_code} - {r['status']}")
 
-    data = {"status": f"{r}"}
+    return r, status_code
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+_transfer_service = None
+
+
+def start_transfer_service():
+    """Run the transfer queue inside this process. New requests are then
+    handed to it directly instead of waiting for the next db poll.
+    """
+    global _transfer_service
+    from utilities import filesyncer
+
+    if _transfer_service is None:
+        _transfer_service = filesyncer.TransferService(
+            db, update_frequency=config.EMBEDDED_QUEUE_POLL_INTERVAL)
+        atexit.register(_transfer_service.stop)
+
+    return _transfer_service.start()
+
+
+def _hand_off(*guids):
+    if _transfer_service is not None and guids:
+        _transfer_service.submit_many(guids)
+
+
+def get_resolver():
+    """Return the background resolver pool, starting it on first use.
+    Started at server start with ASYNC_INTAKE, so requests left pending
+    by a previous run are resolved without waiting for a new one.
+    """
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = resolver.RequestResolver(
+                db, queue_movie_sync_request,
+                workers=config.RESOLVER_WORKERS).start()
+            atexit.register(_resolver.stop, timeout=5)
+
+    return _resolver
+
+
+def accept_movie_sync_request(raw_request):
+    """Validate and persist a sync request without contacting OMDb. The
+    request is resolved later by the background resolver pool.
+    Returns:
+        - tuple(dict(response_data), int(status_code))
+    """
+    if not raw_request or not raw_request.get('path'):
+        return {"status": f"No remote path for file: {raw_request}"}, 400
+
+    guid = raw_request.get('guid')
+    if guid and not plexutils.is_imdb_guid(guid):
+        return {"status": f"Invalid guid: {raw_request}"}, 400
+
+    if db.is_requested(guid=guid, remote_path=raw_request['path']):
+        return {"status": "Item already requested"}, 208
+
+    pool = get_resolver()
+    request_id = utils.correlation_id() or uuid.uuid4().hex
+    db.insert_sync_request(request_id, raw_request['path'], guid=guid)
+    pool.submit(request_id)
+
+    data = {
+        "status": "Accepted",
+        "request_id": request_id,
+        "status_url": config.SYNC_REQUEST_ENDPOINT + request_id,
+    }
+    return data, 202
+
+
+@app.route(config.NEW_MOVIE_ENDPOINT, methods=['POST'])
+def sync_new_movie():
+    """Accept a sync request. The correlation id assigned here is stored
+    with the movie and tags its log lines through the transfer queue.
+    """
+    cid = utils.new_correlation_id()
+    with utils.log_context(correlation_id=cid, component="server"):
+        response = _sync_new_movie()
+    response.headers['X-Correlation-ID'] = cid
+
+    return response
+
+
+def _sync_new_movie():
+    debug = False
+    raw_request = request.get_json()
+    logger.info(f"Request: {raw_request}", stdout=True)
+
+    if config.ASYNC_INTAKE:
+        data, status_code = accept_movie_sync_request(raw_request)
+        if logger.is_enabled("DEBUG"):
+            logger.debug(f"Result: {data} - [{status_code}]")
+        response = app.response_class(response=json.dumps(data),
+                                      status=status_code,
+                                      mimetype='application/json')
+        if status_code == 202:
+            response.headers['Location'] = data['status_url']
+        return response
+
+    r, status_code = queue_movie_sync_request(raw_request, debug=debug)
+
+    data = {"status": f"{r}", "correlation_id": utils.correlation_id()}
     response = app.response_class(response=json.dumps(data),
                                   status=status_code,
                                   mimetype='application/json')
 
     return response
+
+
+@app.route(config.SYNC_REQUEST_ENDPOINT + "<request_id>", methods=['GET'])
+def sync_request_status(request_id):
+    row = db.select_sync_request(request_id)
+    if not row:
+        data = {"status": f"Unknown request: {request_id}"}
+        return app.response_class(response=json.dumps(data), status=404,
+                                  mimetype='application/json')
+
+    data = {
+        "request_id": row['request_id'],
+        "state": row['state'],
+        "status": row['status'],
+        "status_code": row['status_code'],
+        "guid": row['guid'],
+        "path": row['remote_path'],
+        "created_at": row['created_at'],
+        "updated_at": row['updated_at'],
+    }
+    response = app.response_class(response=json.dumps(data), status=200,
+                                  mimetype='application/json')
+
+    return response
+
+
+def _parse_bulk_request():
+    """Read the items of a bulk sync request. Accepts either a JSON array
+    or NDJSON (one JSON object per line). Lines that fail to parse are kept
+    as None so they can be reported back by index.
+    Returns:
+        - list of raw request items, or None if the body is not a list
+    """
+    if request.mimetype == "application/json":
+        raw_request = request.get_json(silent=True)
+        if not isinstance(raw_request, list):
+            return None
+        return raw_request
+
+    items = []
+    for line in request.stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+
+    return items
+
+
+def _allowed_remote_hosts():
+    """SFTP hosts a sync request may name as its source."""
+    return {config.REMOTE_FILE_SERVER, *config.REMOTE_FILE_SERVERS}
+
+
+def validate_bulk_item(raw_item):
+    """Validate one item of a bulk sync request without contacting OMDb.
+    Bulk requests must carry an IMDb guid; path-only requests go through
+    the single-item endpoint so the guid can be resolved.
+    Returns:
+        - tuple(dict(request_data), int(status_code))
+    """
+    request_data = {
+        "guid": None,
+        "path": None,
+        "status": None,
+    }
+
+    if not isinstance(raw_item, dict):
+        request_data['status'] = f"Invalid item: {raw_item}"
+        return request_data, 400
+
+    request_data['guid'] = raw_item.get('guid')
+    request_data['path'] = raw_item.get('path')
+    if raw_item.get('host'):
+        request_data['host'] = raw_item['host']
+
+    if not request_data['path']:
+        request_data['status'] = f"No remote path for file: {raw_item}"
+        return request_data, 400
+
+    if request_data.get('host') and \
+            request_data['host'] not in _allowed_remote_hosts():
+        request_data['status'] = f"Unknown remote host: {raw_item}"
+        return request_data, 400
+
+    if not plexutils.is_imdb_guid(request_data['guid']):
+        request_data['status'] = f"Missing or invalid guid: {raw_item}"
+        return request_data, 400
+
+    request_data['status'] = "Success"
+    return request_data, 200
+
+
+@app.route(config.NEW_MOVIES_ENDPOINT, methods=['POST'])
+def sync_new_movies():
+    raw_items = _parse_bulk_request()
+    if raw_items is None:
+        data = {"status": "Expected a JSON array or NDJSON body"}
+        return app.response_class(response=json.dumps(data), status=400,
+                                  mimetype='application/json')
+
+    logger.info(f"Bulk request: {len(raw_items)} items")
+
+    results = []
+    to_insert = []
+    seen_guids = set()
+    for raw_item in raw_items:
+        r, status_code = validate_bulk_item(raw_item)
+        if status_code == 200 and r['guid'] in seen_guids:
+            status_code = 208
+            r['status'] = "Item already requested"
+        elif status_code == 200:
+            seen_guids.add(r['guid'])
+            r['correlation_id'] = utils.new_correlation_id()
+            to_insert.append(r)
+        results.append([r, status_code])
+
+    inserted = iter(db.insert_many(
+        [(r['guid'], r['path'], r.get('host'), r['correlation_id'])
+         for r in to_insert]))
+    new_guids = []
+    for result in results:
+        r, status_code = result
+        if status_code == 200 and not next(inserted):
+            result[1] = 208
+            r['status'] = "Item already requested"
+        elif status_code == 200:
+            events.broadcaster.publish(
+                events.MOVIE_STATE, guid=r['guid'], path=r['path'],
+                state=dbutils.PENDING)
+            new_guids.append(r['guid'])
+    _hand_off(*new_guids)
+
+    items = []
+    for index, (r, status_code) in enumerate(results):
+        r['index'] = index
+        r['code'] = status_code
+        items.append(r)
+
+    summary = {
+        "inserted": sum(1 for i in items if i['code'] == 200),
+        "duplicates": sum(1 for i in items if i['code'] == 208),
+        "invalid": sum(1 for i in items if i['code'] == 400),
+    }
+    logger.info(f"Bulk result: {summary}")
+
+    data = {"status": summary, "items": items}
+    response = app.response_class(response=json.dumps(data),
+                                  status=200,
+                                  mimetype='application/json')
+
+    return response
+
+
+def _movie_status(row):
+    """Format a remote_movies row for the status endpoints."""
+    progress = None
+    if row['total_bytes']:
+        progress = round(
+            100 * row['bytes_transferred'] / row['total_bytes'], 1)
+
+    return {
+        "id": row['id'],
+        "guid": row['guid'],
+        "path": row['remote_path'],
+        "host": row['remote_host'],
+        "correlation_id": row['correlation_id'],
+        "state": row['state'],
+        "bytes_transferred": row['bytes_transferred'],
+        "total_bytes": row['total_bytes'],
+        "progress": progress,
+        "attempts": row['attempts'],
+        "next_attempt_at": row['next_attempt_at'],
+        "last_error": row['last_error'],
+        "updated_at": row['updated_at'],
+    }
+
+
+def _conditional_json_response(data):
+    """Build a JSON response with a content ETag. A matching If-None-Match
+    header turns it into an empty 304.
+    """
+    body = json.dumps(data)
+    response = app.response_class(response=body, status=200,
+                                  mimetype='application/json')
+    response.set_etag(hashlib.sha1(body.encode("utf-8")).hexdigest())
+
+    return response.make_conditional(request)
+
+
+@app.route(config.QUEUE_ENDPOINT, methods=['GET'])
+def queue_status():
+    states = request.args.get("state")
+    if states:
+        states = tuple(s for s in states.split(",") if s)
+        unknown = [s for s in states if s not in dbutils.MOVIE_STATES]
+        if unknown:
+            data = {"status": f"Unknown state: {unknown}",
+                    "states": list(dbutils.MOVIE_STATES)}
+            return app.response_class(response=json.dumps(data), status=400,
+                                      mimetype='application/json')
+    else:
+        states = dbutils.MOVIE_STATES
+
+    try:
+        cursor = int(request.args.get("cursor", 0))
+        limit = int(request.args.get("limit", config.QUEUE_PAGE_SIZE))
+    except ValueError:
+        data = {"status": "cursor and limit must be integers"}
+        return app.response_class(response=json.dumps(data), status=400,
+                                  mimetype='application/json')
+    limit = max(1, min(limit, 500))
+
+    rows = db.select_movies_page(states=states, after_id=cursor, limit=limit)
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = rows[-1]['id']
+
+    data = {
+        "items": [_movie_status(row) for row in rows],
+        "next_cursor": next_cursor,
+        "counts": db.count_by_state(),
+    }
+
+    return _conditional_json_response(data)
+
+
+@app.route(config.MOVIE_STATUS_ENDPOINT + "<guid>", methods=['GET'])
+def movie_status(guid):
+    row = db.select_guid(guid)
+    if not row:
+        data = {"status": f"Unknown guid: {guid}"}
+        return app.response_class(response=json.dumps(data), status=404,
+                                  mimetype='application/json')
+
+    return _conditional_json_response(_movie_status(row))
+
+
+@app.route(config.TRANSFER_STATS_ENDPOINT, methods=['GET'])
+def transfer_stats():
+    """Throughput percentiles of finished transfers, grouped by day or by
+    remote host. Optional query args: by=day|host, days=N
+    """
+    group_by = request.args.get("by", "day")
+    if group_by not in ("day", "host"):
+        data = {"status": f"Unknown grouping: {group_by}",
+                "groupings": ["day", "host"]}
+        return app.response_class(response=json.dumps(data), status=400,
+                                  mimetype='application/json')
+
+    try:
+        days = int(request.args.get("days", 30))
+    except ValueError:
+        data = {"status": "days must be an integer"}
+        return app.response_class(response=json.dumps(data), status=400,
+                                  mimetype='application/json')
+    since = time.time() - days * 86400
+
+    data = {
+        "by": group_by,
+        "days": days,
+        "unit": "bytes/s",
+        "groups": db.throughput_percentiles(group_by=group_by, since=since),
+    }
+
+    return _conditional_json_response(data)
+
+
+@app.route(config.EVENTS_ENDPOINT, methods=['GET'])
+def event_stream():
+    """Stream queue and transfer events as Server-Sent Events. Each client
+    gets its own bounded buffer; if it falls behind, a "dropped" event
+    tells it to re-read the queue endpoint.
+    """
+    subscription = events.broadcaster.subscribe()
+    logger.debug(f"Event subscriber connected "
+                 f"[{events.broadcaster.subscriber_count}]")
+
+    def stream():
+        dropped = 0
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                event = subscription.get(timeout=15)
+                if subscription.dropped != dropped:
+                    data = json.dumps(
+                        {"dropped": subscription.dropped - dropped})
+                    dropped = subscription.dropped
+                    yield f"event: dropped\ndata: {data}\n\n"
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event['id']}\nevent: {event['type']}\n" \
+                      f"data: {json.dumps(event)}\n\n"
+        finally:
+            events.broadcaster.unsubscribe(subscription)
+            logger.debug("Event subscriber disconnected")
+
+    response = app.response_class(stream(), mimetype="text/event-stream")
+    response.headers['Cache-Control'] = "no-cache"
+    response.headers['X-Accel-Buffering'] = "no"
+
+    return response
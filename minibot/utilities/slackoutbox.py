@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Outbound Slack queue for the file syncer. Messages are persisted to the
+slack_outbox table and sent by a background thread, with retries.
+"""
+import json
+import threading
+import time
+
+from utilities import config
+from utilities import logger
+from utilities import utils
+from utilities.slackutils import SlackSender
+from utilities.utils import StoppableThread
+
+
+class SlackOutbox(object):
+    """Background sender for messages persisted in the slack_outbox table.
+    Requires:
+        - database: FileTransferDB holding the slack_outbox table
+    Optional kwargs:
+        - batch_size (int): messages loaded from the db at a time
+        - max_messages (int): undelivered messages kept before the oldest
+          are dropped
+        - poll_interval (int): seconds between checks for due retries
+    """
+
+    def __init__(self, database, batch_size=None, max_messages=None,
+                 poll_interval=5):
+        self.db = database
+        self.batch_size = batch_size or config.SLACK_OUTBOX_BATCH
+        self.max_messages = max_messages or config.SLACK_OUTBOX_MAX_MESSAGES
+        self.poll_interval = poll_interval
+        self.lease_seconds = 60
+        # Sends must give up well before their lease lets another sender
+        # claim the same message
+        self.send_timeout = self.lease_seconds / 2
+        self.session = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        import requests
+
+        self.session = requests.Session()
+        self._thread = StoppableThread(target=self._run, name="slack-outbox",
+                                       daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self, timeout=5):
+        if self._thread:
+            self._thread.stop()
+            self._wake.set()
+            self._thread.join(timeout)
+            self._thread = None
+        if self.session:
+            self.session.close()
+
+    def enqueue(self, webhook_url, payload):
+        """Persist a message for the sender. Never raises.
+        Returns:
+            - bool: whether the message was stored
+        """
+        try:
+            message_id, dropped = self.db.enqueue_slack(
+                webhook_url, json.dumps(payload, default=str),
+                max_messages=self.max_messages)
+        except Exception as e:
+            logger.error(f"Failed to queue Slack notification: {str(e)}")
+            return False
+
+        if dropped:
+            logger.warning(f"Slack outbox full, dropped {dropped} oldest "
+                           f"messages")
+        logger.debug(f"Queued Slack notification: {message_id}")
+        self._wake.set()
+
+        return True
+
+    def _run(self):
+        while not threading.current_thread().stopped():
+            try:
+                rows = self.db.claim_slack(limit=self.batch_size,
+                                           lease_seconds=self.lease_seconds)
+            except Exception as e:
+                logger.error(f"Failed to read Slack outbox: {str(e)}")
+                rows = []
+
+            if not rows:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+
+            for index, row in enumerate(rows):
+                try:
+                    paused_until = self._deliver(row)
+                except Exception as e:
+                    # The lease expires and the message is claimed again
+                    logger.error(f"Failed to record Slack notification "
+                                 f"outcome: {row['id']} {str(e)}")
+                    continue
+                if paused_until:
+                    # Everything else waits out the rate limit or the open
+                    # circuit without using up an attempt
+                    self._pause(rows[index + 1:], paused_until)
+                    threading.current_thread().wait(
+                        max(0, paused_until - time.time()))
+                    break
+
+    def _pause(self, rows, paused_until):
+        for row in rows:
+            try:
+                self.db.retry_slack(row['id'], paused_until, attempt=False)
+            except Exception as e:
+                logger.error(f"Failed to postpone Slack notification: "
+                             f"{row['id']} {str(e)}")
+
+    def _deliver(self, row):
+        """Send one message and record the outcome.
+        Returns:
+            - float(epoch time) to pause the sender until, or None
+        """
+        sender = SlackSender(webhook_url=row['webhook_url'],
+                             session=self.session)
+        try:
+            response = sender.post(json.loads(row['payload']),
+                                   timeout=self.send_timeout)
+        except utils.CircuitOpenError as e:
+            paused_until = time.time() + e.retry_after
+            self.db.retry_slack(row['id'], paused_until, str(e),
+                                attempt=False)
+            return paused_until
+        except Exception as e:
+            self._retry(row, f"{type(e).__name__}: {str(e)}")
+            return None
+
+        if response.status_code == 200:
+            self.db.delete_slack(row['id'])
+            logger.debug(f"Sent Slack notification: {row['id']}")
+            return None
+
+        error = f"[{response.status_code}] {response.text}"
+        if response.status_code == 429:
+            try:
+                delay = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                delay = utils.backoff_delay(
+                    row['attempts'] + 1,
+                    base_delay=config.SLACK_RETRY_BASE_DELAY,
+                    max_delay=config.SLACK_RETRY_MAX_DELAY)
+            paused_until = time.time() + delay
+            logger.warning(f"Slack rate limited, pausing for {delay:.0f} "
+                           f"seconds")
+            self.db.retry_slack(row['id'], paused_until, error,
+                                attempt=False)
+            return paused_until
+
+        if response.status_code < 500:
+            logger.error(f"Dropping undeliverable Slack notification: "
+                         f"{row['id']} {error}")
+            self.db.delete_slack(row['id'])
+            return None
+
+        self._retry(row, error)
+
+        return None
+
+    def _retry(self, row, error):
+        attempts = row['attempts'] + 1
+        if attempts >= config.SLACK_MAX_ATTEMPTS:
+            logger.error(f"Dropping Slack notification after {attempts} "
+                         f"attempts: {row['id']} {error}")
+            self.db.delete_slack(row['id'])
+            return
+
+        delay = utils.backoff_delay(
+            attempts, base_delay=config.SLACK_RETRY_BASE_DELAY,
+            max_delay=config.SLACK_RETRY_MAX_DELAY)
+        logger.warning(f"Slack notification failed, retrying in "
+                       f"{delay:.0f} seconds: {row['id']} {error}")
+        self.db.retry_slack(row['id'], time.time() + delay, error)
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """Return the process-wide outbox, starting its sender on first use.
+    Messages left by a previous run are sent as soon as it starts.
+    """
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            from utilities import db
+            _outbox = SlackOutbox(db).start()
+
+    return _outbox
+
+
+def stop_outbox(timeout=5):
+    """Stop the process-wide outbox's sender, if it was started. Messages
+    it has not sent yet stay in the table for the next run.
+    """
+    global _outbox
+    with _outbox_lock:
+        outbox, _outbox = _outbox, None
+    if outbox:
+        outbox.stop(timeout)
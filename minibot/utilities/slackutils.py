@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 import json
+import threading
+import time
 
 import requests
 
+from utilities import constants
+from utilities import logger
+from utilities import metrics
+from utilities import tracing
+from utilities import utils
+
 
 class SlackException(Exception):
     """Custom exception for Slack related failures."""
@@ -11,8 +19,10 @@ class SlackException(Exception):
 
 class SlackSender(object):
     def __init__(self, webhook_url=None, channel=None, user=None,
-                 json_attachments=None, debug=False, dryrun=False):
+                 json_attachments=None, debug=False, dryrun=False,
+                 session=None):
         self.debug = debug
+        self.session = session
         self.dryrun = dryrun
         self.webhook_url = webhook_url
         self.json_attachments = json_attachments
@@ -52,9 +62,11 @@ class SlackSender(object):
 
         return self.json_attachments
 
-    def send(self):
-        """Send the Slack notification with the current json_attachments.
-        This will update the debug state, channel, and webhook before sending.
+    def build_payload(self):
+        """Build the json payload for the current json_attachments without
+        sending it.
+        Returns:
+            - dict(payload)
         """
         if not self.user:
             raise SlackException("Missing user")
@@ -74,18 +86,213 @@ class SlackSender(object):
         if self.debug:
             print(f"json payload: {self._json_payload}")
 
+        return self._json_payload
+
+    def send(self):
+        """Send the Slack notification with the current json_attachments.
+        This will update the debug state, channel, and webhook before sending.
+        """
+        payload = self.build_payload()
+
         if self.dryrun:
             print("[Dry run. Not posting message.]")
             return
 
-        response = requests.post(
-            self.webhook_url, data=json.dumps(self._json_payload),
-            headers={"Content-Type": "application/json"}
-        )
+        response = self.post(payload)
         print(f"Result: {response.text} [{response.status_code}]")
 
         return response
 
+    @tracing.traced("slack.send")
+    def post(self, payload, timeout=None):
+        """Post an already built payload to the webhook.
+        Optional kwargs:
+            - timeout (float): seconds to wait for the webhook
+        Returns:
+            - requests.Response
+        """
+        with utils.circuit_breaker("slack").guard() as mark_failed:
+            with metrics.dependency_call("slack", "send"):
+                response = (self.session or requests).post(
+                    self.webhook_url, data=json.dumps(payload),
+                    headers={"Content-Type": "application/json"},
+                    timeout=timeout
+                )
+            if response.status_code >= 500:
+                mark_failed()
+        if response.status_code != 200:
+            metrics.DEPENDENCY_ERRORS.inc(
+                dependency="slack", operation="send")
+
+        return response
+
+
+class SlackProgressMessage(object):
+    """A single Slack message that shows live progress. The first state is
+    posted with chat.postMessage through a bot token. Later states are
+    applied to the same message with chat.update, at most once per
+    interval seconds, so only the latest state is ever sent. Rate limit
+    responses push the next edit back by their Retry-After. If the first
+    post fails, or no state arrives for idle_timeout seconds, the message
+    is given up on and later states are dropped.
+
+    Calls are made from a background thread. update() and finish() never
+    block or raise, and a failing message never holds up the caller.
+    Requires:
+        - str(token): bot token with chat:write
+        - str(channel): channel name or id to post in
+    Optional kwargs:
+        - interval (int): minimum seconds between edits
+        - idle_timeout (int): seconds without a new state before the
+          sender thread exits, e.g. when finish() is never called
+    """
+
+    def __init__(self, token, channel, interval=10, session=None,
+                 idle_timeout=900):
+        self.token = token
+        self.channel = channel
+        self.interval = interval
+        self.session = session
+        self.idle_timeout = idle_timeout
+        self.ts = None
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._pending = None
+        self._final = False
+        self._next_send = 0
+        self._thread = None
+
+    def update(self, text, title=None, color=None):
+        """Set the state to show next. States set faster than the interval
+        replace each other and only the latest is sent."""
+        with self._lock:
+            if self._final:
+                return
+            self._pending = self._attachment(text, title, color)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="slack-progress", daemon=True)
+                self._thread.start()
+        self._changed.set()
+
+    def finish(self, text, title=None, color=None):
+        """Set the final state. It is sent as soon as the rate limit allows,
+        after which the message is no longer edited."""
+        self.update(text, title=title, color=color)
+        with self._lock:
+            self._final = True
+        self._changed.set()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    @staticmethod
+    def _attachment(text, title, color):
+        attachment = {
+            "fallback": title or text,
+            "color": text_color(color or "info"),
+            "text": text,
+        }
+        if title:
+            attachment['title'] = title
+
+        return attachment
+
+    def _run(self):
+        while True:
+            if not self._changed.wait(self.idle_timeout):
+                logger.warning(f"No progress for {self.idle_timeout} "
+                               f"seconds, no longer updating Slack message")
+                self._give_up()
+                return
+            delay = self._next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self._lock:
+                self._changed.clear()
+                attachment, self._pending = self._pending, None
+
+            if attachment:
+                self._send(attachment)
+            with self._lock:
+                if self._final and self._pending is None:
+                    return
+
+    def _give_up(self):
+        """Drop the pending state and ignore any later ones."""
+        with self._lock:
+            self._final = True
+            self._pending = None
+
+    def _send(self, attachment):
+        payload = {
+            "channel": self.channel,
+            "text": attachment['fallback'],
+            "attachments": [attachment],
+        }
+        method = "chat.postMessage"
+        if self.ts:
+            method = "chat.update"
+            payload['ts'] = self.ts
+
+        self._next_send = time.monotonic() + self.interval
+        try:
+            with utils.circuit_breaker("slack").guard() as mark_failed:
+                with metrics.dependency_call("slack", method):
+                    response = (self.session or requests).post(
+                        constants.SLACK_API_URL + method,
+                        data=json.dumps(payload),
+                        headers={
+                            "Content-Type": "application/json; "
+                                            "charset=utf-8",
+                            "Authorization": f"Bearer {self.token}",
+                        },
+                        timeout=30
+                    )
+                if response.status_code >= 500:
+                    mark_failed()
+        except Exception as e:
+            logger.warning(f"Slack {method} failed: {str(e)}")
+            if not self.ts:
+                # Posting again would only add duplicate messages
+                self._give_up()
+            return
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                retry_after = self.interval
+            self._next_send = time.monotonic() + retry_after
+            self._requeue(attachment)
+            return
+
+        try:
+            result = json.loads(response.text)
+        except ValueError:
+            result = {"ok": False, "error": response.text}
+        if not result.get("ok"):
+            metrics.DEPENDENCY_ERRORS.inc(dependency="slack",
+                                          operation=method)
+            logger.warning(f"Slack {method} failed: {result.get('error')}")
+            if not self.ts:
+                self._give_up()
+            return
+
+        if not self.ts:
+            self.ts = result['ts']
+            self.channel = result.get("channel", self.channel)
+
+    def _requeue(self, attachment):
+        """Put back a state that was rate limited unless a newer one has
+        replaced it in the meantime."""
+        with self._lock:
+            if self._pending is None:
+                self._pending = attachment
+        self._changed.set()
+
 
 def text_color(requested_color):
     """Takes a color alias (str) and returns the color value if available"""
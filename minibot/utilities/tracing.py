@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Timed spans around the sync pipeline stages, written to TRACE_FILE in
+the Chrome trace event format for chrome://tracing or ui.perfetto.dev.
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+from utilities import config
+from utilities import utils
+
+
+class Tracer(object):
+    """Appends complete ("X") trace events to file_path, one per line.
+    The JSON array is left open so that any number of processes and runs
+    can append to the same file; trace viewers accept the missing "]".
+    """
+
+    def __init__(self, file_path):
+        self.file_path = os.path.expanduser(file_path)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def _open(self):
+        if self._file is None or self._pid != os.getpid():
+            new = not os.path.exists(self.file_path) or \
+                os.path.getsize(self.file_path) == 0
+            self._file = open(self.file_path, "a")
+            self._pid = os.getpid()
+            if new:
+                self._file.write("[\n")
+
+        return self._file
+
+    def record(self, name, start, duration, args=None):
+        event = {
+            "name": name,
+            "cat": name.split(".")[0],
+            "ph": "X",
+            "ts": round(start * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args or {},
+        }
+        line = json.dumps(event, default=str) + ",\n"
+        with self._lock:
+            trace_file = self._open()
+            trace_file.write(line)
+            trace_file.flush()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Time the enclosed block. Yields the span's args dict so the
+        block can attach more detail; an exception is recorded in it.
+        """
+        cid = utils.correlation_id()
+        if cid:
+            args['correlation_id'] = cid
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = f"{type(e).__name__}: {str(e)}"
+            raise
+        finally:
+            self.record(name, start, time.perf_counter() - started, args)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+_tracer = None
+_noop = contextlib.nullcontext()
+
+
+def enable(file_path):
+    global _tracer
+    disable()
+    _tracer = Tracer(file_path)
+
+    return _tracer
+
+
+def disable():
+    global _tracer
+    if _tracer:
+        _tracer.close()
+    _tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, **args):
+    """Context manager timing one stage, e.g.
+        with tracing.span("sync_item", guid=guid): ...
+    """
+    if _tracer is None:
+        return _noop
+
+    return _tracer.span(name, **args)
+
+
+def traced(name):
+    """Decorator recording a span named name around each call."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+if config.TRACE_FILE:
+    enable(config.TRACE_FILE)
@@ -1,20 +1,122 @@
 #!/usr/bin/env python3
+import atexit
+import contextlib
+import contextvars
+import fcntl
 import functools
+import hashlib
+import json
 import math
+import os
 import os.path
+import queue
+import random
 import threading
 import time
+import uuid
+import weakref
+
+from utilities import config
+from utilities import metrics
+
+
+_log_levels = {
+    "DEBUG": 10,
+    "INFO": 20,
+    "WARNING": 30,
+    "ERROR": 40,
+    "CRITICAL": 50,
+}
+
+_loggers = weakref.WeakSet()
+
+_correlation_id = contextvars.ContextVar("correlation_id", default=None)
+_component = contextvars.ContextVar("component", default=None)
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+
+def correlation_id():
+    """Return the correlation id of the current log context, if any."""
+    return _correlation_id.get()
+
+
+@contextlib.contextmanager
+def log_context(correlation_id=None, component=None):
+    """Tag every line logged inside the block, in this thread, with a
+    correlation id and/or component name. Blocks nest; an inner block only
+    overrides the values it is given. Can also be used as a decorator.
+    """
+    tokens = []
+    if correlation_id is not None:
+        tokens.append((_correlation_id, _correlation_id.set(correlation_id)))
+    if component is not None:
+        tokens.append((_component, _component.set(component)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
 
 
 class Logger(object):
-    def __init__(self, file_path=None, stdout=False):
+    """Appends log lines to a file, optionally echoing them to stdout.
+    Messages below level are dropped before they are formatted. When
+    buffered, lines are handed to a background writer thread through a
+    bounded queue and written in batches to a file that stays open; if the
+    queue is full, DEBUG lines are dropped rather than blocking the caller.
+    The file is rotated once it reaches max_bytes or is older than
+    rotate_interval seconds, keeping backup_count old files. Several
+    processes can share one file: only the one holding <file>.lock
+    rotates it, and the others reopen it once it has been moved away.
+    With log_format "json" each file line is a JSON object carrying the
+    correlation id and component of the current log_context; stdout keeps
+    the plain text format.
+    """
+
+    def __init__(self, file_path=None, stdout=False, level="DEBUG",
+                 buffered=True, queue_size=10000, max_bytes=0,
+                 backup_count=5, rotate_interval=0, flush_interval=1.0,
+                 log_format="text"):
         self._file_path = self._create_log_file(file_path=file_path)
         self._stdout = stdout
+        self.log_format = log_format
+        self.level = level
+        self.buffered = buffered
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.flush_interval = flush_interval
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+        self._file = None
+        _loggers.add(self)
 
     @property
     def file_path(self):
         return self._file_path
 
+    @property
+    def level(self):
+        return self._level_name
+
+    @level.setter
+    def level(self, level):
+        self._level_name = level.upper()
+        self._level = _log_levels[self._level_name]
+
+    def is_enabled(self, log_type):
+        """Returns True if messages of log_type would be logged, so hot
+        paths can skip building expensive debug messages.
+        """
+        return _log_levels[log_type] >= self._level
+
     def critical(self, message, stdout=False):
         self._log(message, "CRITICAL", stdout)
 
@@ -31,21 +133,189 @@ class Logger(object):
         self._log(message, "DEBUG", stdout)
 
     def _log(self, message, log_type, stdout=False):
-        log_line = self._log_formatter(message, log_type)
-        self._append_to_log(log_line)
-        if stdout or self._stdout:
-            print(log_line.rstrip())
+        level = _log_levels[log_type]
+        if level < self._level:
+            return
+
+        record = (time.time(), log_type, message, stdout or self._stdout,
+                  _correlation_id.get(),
+                  _component.get() or threading.current_thread().name)
+        if not self.buffered:
+            with self._lock:
+                self._write([record])
+            return
+
+        self._ensure_writer()
+
+        try:
+            if level > _log_levels["DEBUG"]:
+                self._queue.put(record, timeout=1)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_writer(self):
+        """Start the writer thread on first use, and again in a forked
+        child, which does not inherit its parent's threads.
+        """
+        if self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+
+        with self._lock:
+            if self._writer_pid != os.getpid() or \
+                    not self._writer.is_alive():
+                self._file = None
+                self._writer = StoppableThread(
+                    target=self._run_writer, name="log-writer", daemon=True)
+                self._writer_pid = os.getpid()
+                self._writer.start()
+
+    def _run_writer(self):
+        thread = threading.current_thread()
+        while not thread.stopped():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self._lock:
+                    self._write(batch)
+            except Exception as e:
+                print(f"ERROR - Failed to write log: {str(e)}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, records):
+        lines = []
+        for created, log_type, message, stdout, cid, component in records:
+            log_line = self._log_formatter(message, log_type, created)
+            if self.log_format == "json":
+                lines.append(self._json_formatter(
+                    message, log_type, created, cid, component))
+            else:
+                lines.append(log_line)
+            if stdout:
+                print(log_line.rstrip())
+
+        if self.dropped:
+            message = f"Log queue full, dropped {self.dropped} messages"
+            if self.log_format == "json":
+                lines.append(self._json_formatter(
+                    message, "WARNING", time.time(), None, "logger"))
+            else:
+                lines.append(self._log_formatter(message, "WARNING"))
+            self.dropped = 0
+
+        self._rotate_if_needed()
+        self._open().write("".join(lines))
+        self._file.flush()
 
     @staticmethod
-    def _log_formatter(message, msg_type):
-        ts = time.strftime("%Y-%m-%d %H:%M:%S")
+    def _log_formatter(message, msg_type, created=None):
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created))
         log_line = f"{ts} {msg_type}: {message}\n"
 
         return log_line
 
-    def _append_to_log(self, log_line):
-        with open(self._file_path, "a") as log:
-            log.write(log_line)
+    @staticmethod
+    def _json_formatter(message, msg_type, created, cid, component):
+        ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(created))
+        log_line = json.dumps({
+            "ts": f"{ts}.{int(created % 1 * 1000):03d}Z",
+            "level": msg_type,
+            "component": component,
+            "correlation_id": cid,
+            "message": str(message),
+        })
+
+        return log_line + "\n"
+
+    def _open(self):
+        if self._file is not None and not self._same_file():
+            # Another process rotated the file, follow it to the new one
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._file = open(self._file_path, "a")
+
+        return self._file
+
+    def _same_file(self):
+        try:
+            return os.stat(self._file_path).st_ino == \
+                os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _rotation_due(self, lock_path):
+        try:
+            too_big = self.max_bytes and \
+                os.stat(self._file_path).st_size >= self.max_bytes
+        except FileNotFoundError:
+            return False
+        # The lock file's mtime marks the last rotation by any process
+        too_old = self.rotate_interval and \
+            time.time() - os.stat(lock_path).st_mtime >= self.rotate_interval
+
+        return bool(too_big or too_old)
+
+    def _rotate_if_needed(self):
+        if not self.max_bytes and not self.rotate_interval:
+            return
+
+        lock_path = f"{self._file_path}.lock"
+        with open(lock_path, "a") as lock:
+            if not self._rotation_due(lock_path):
+                return
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is rotating it
+                return
+            # Check again, another process may have just rotated it
+            if not self._rotation_due(lock_path):
+                return
+
+            if self._file:
+                self._file.close()
+                self._file = None
+            for i in range(self.backup_count - 1, 0, -1):
+                older = f"{self._file_path}.{i}"
+                if os.path.exists(older):
+                    os.replace(older, f"{self._file_path}.{i + 1}")
+            if self.backup_count:
+                os.replace(self._file_path, f"{self._file_path}.1")
+            else:
+                os.remove(self._file_path)
+            os.utime(lock_path)
+
+    def flush(self, timeout=5):
+        """Wait up to timeout seconds for queued lines to be written."""
+        if not self._writer or not self._writer.is_alive() or \
+                self._writer_pid != os.getpid():
+            return
+
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._writer:
+                self._writer.stop()
+            if self._file:
+                self._file.close()
+                self._file = None
+        self.buffered = False
 
     @staticmethod
     def _create_log_file(file_path=None):
@@ -75,6 +345,37 @@ class Logger(object):
         return file_path
 
 
+class BloomFilter(object):
+    """Probabilistic set membership. A key that was added is always found;
+    a key that was not added is found with a probability of about
+    error_rate. Keys cannot be removed.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.capacity = capacity
+        self.count = 0
+        self.size = max(8, int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(key))
+
+
 class StoppableThread(threading.Thread):
     """Thread class with a stop() method. The thread itself has to check
     regularly for the stopped() condition."""
@@ -89,6 +390,11 @@ class StoppableThread(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
+    def wait(self, timeout=None):
+        """Sleep for up to timeout seconds, returning early with True if the
+        thread is stopped in the meantime."""
+        return self._stop_event.wait(timeout)
+
 
 def conv_millisec_to_min(milliseconds):
     """Requires int(milliseconds) and converts it to minutes.
@@ -117,6 +423,38 @@ def convert_file_size(size_bytes):
     return f"{s} {size_name[i]}"
 
 
+def percentile(sorted_values, pct):
+    """Return the pct percentile of an already sorted list, interpolating
+    linearly between the closest ranks.
+    Requires:
+        - list of numbers, sorted ascending
+        - int or float(pct) between 0 and 100
+    Returns:
+        - float, or None for an empty list
+    """
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * pct / 100
+    low = math.floor(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    fraction = rank - low
+
+    return sorted_values[low] + \
+        (sorted_values[high] - sorted_values[low]) * fraction
+
+
+def backoff_delay(attempt, base_delay=60, max_delay=3600, jitter=0.5):
+    """Exponential backoff for the given 1-based attempt number, capped at
+    max_delay. Up to jitter (a fraction) of the delay is randomly taken off
+    so that items failing together do not all retry together.
+    Returns:
+        - float(seconds)
+    """
+    delay = min(max_delay, base_delay * 2 ** max(attempt - 1, 0))
+
+    return delay * (1 - jitter * random.random())
+
+
 def retry(attempts=3, exception_to_check=Exception,
           delay=3, backoff=2, logger=None):
     """Retry decorator to call function up to specified number of times in
@@ -136,6 +474,7 @@ def retry(attempts=3, exception_to_check=Exception,
                         logger.warning(message)
                     else:
                         print(message)
+                    metrics.RETRIES.inc(function=func.__qualname__)
                     time.sleep(this_delay)
                     this_attempts -= 1
                     this_delay *= backoff
@@ -146,10 +485,158 @@ def retry(attempts=3, exception_to_check=Exception,
     return decorator
 
 
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open."""
+
+    def __init__(self, name, retry_after=0):
+        super().__init__(f"Circuit open: {name} "
+                         f"(retry in {round(retry_after)} seconds)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Stops calls to a failing dependency. After failure_threshold
+    consecutive failures the circuit opens and calls fail fast with
+    CircuitOpenError. Once reset_timeout seconds have passed it goes
+    half-open and lets up to half_open_trials calls through: a success
+    closes the circuit again, a failure re-opens it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60,
+                 half_open_trials=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_trials = half_open_trials
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    def _current_state(self):
+        if self._state == self.OPEN and \
+                time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+
+        return self._state
+
+    def _set_state(self, state):
+        self._state = state
+        self._trials = 0
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        elif state == self.CLOSED:
+            self._failures = 0
+        metrics.CIRCUIT_OPEN.set(int(state == self.OPEN),
+                                 dependency=self.name)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def retry_after(self):
+        """Seconds until an open circuit goes half-open, 0 otherwise."""
+        with self._lock:
+            if self._current_state() != self.OPEN:
+                return 0
+            return self.reset_timeout - (time.monotonic() - self._opened_at)
+
+    def available(self):
+        """True unless the circuit is open. Does not use up a trial."""
+        return self.state != self.OPEN
+
+    def before_call(self):
+        with self._lock:
+            state = self._current_state()
+            if state == self.HALF_OPEN and \
+                    self._trials < self.half_open_trials:
+                self._trials += 1
+                return
+            if state != self.CLOSED:
+                retry_after = self.reset_timeout - (
+                    time.monotonic() - self._opened_at)
+                raise CircuitOpenError(self.name, max(retry_after, 0))
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED or self._failures:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and
+                    self._failures >= self.failure_threshold):
+                self._set_state(self.OPEN)
+
+    def _cancel_trial(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._trials:
+                self._trials -= 1
+
+    @contextlib.contextmanager
+    def guard(self):
+        """Run the enclosed call through the breaker. Raises
+        CircuitOpenError without running it while the circuit is open.
+        An exception in the block counts as a failure, as does calling
+        the yielded mark_failed, e.g. for an HTTP 5xx response.
+        """
+        self.before_call()
+        failed = []
+        try:
+            yield lambda: failed.append(True)
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            self._cancel_trial()
+            raise
+        if failed:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(name):
+    """Return the process-wide CircuitBreaker for a dependency, e.g.
+    "plex", "omdb" or "slack", creating it from config on first use.
+    """
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(name)
+        if breaker is None:
+            breaker = _circuit_breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+                reset_timeout=config.CIRCUIT_RESET_TIMEOUT)
+
+    return breaker
+
+
 class SigInt(Exception):
     pass
 
 
+def flush_loggers():
+    for log in list(_loggers):
+        log.flush()
+
+
 def interrupt_handler(sig, frame):
     msg = f"Received signal: {str(sig)}"
+    flush_loggers()
     raise SigInt(msg)
+
+
+atexit.register(flush_loggers)
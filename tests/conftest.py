@@ -0,0 +1,41 @@
+import importlib.util
+import os
+import sys
+import tempfile
+
+import pytest
+
+MINIBOT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "minibot")
+sys.path.insert(0, MINIBOT_DIR)
+
+# Without a config.py, e.g. on a fresh checkout, run against the example
+if not os.path.exists(os.path.join(MINIBOT_DIR, "utilities", "config.py")):
+    _spec = importlib.util.spec_from_file_location(
+        "utilities.config",
+        os.path.join(MINIBOT_DIR, "utilities", "config_example.py"))
+    _config = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_config)
+    _config.TEST_ENDPOINT = getattr(_config, "TEST_ENDPOINT", "/test/")
+    sys.modules["utilities.config"] = _config
+
+import utilities  # noqa: E402
+from utilities import dbutils  # noqa: E402
+
+# Keep test runs out of the real log
+utilities.logfile = os.path.join(tempfile.mkdtemp(prefix="minibot-"),
+                                 "plexbot.log")
+
+
+@pytest.fixture
+def transfer_db(tmp_path):
+    database = dbutils.FileTransferDB(db_path=str(tmp_path / "movies.db"))
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def spool(tmp_path):
+    sync_spool = dbutils.SyncSpool(str(tmp_path / "spool.db"))
+    yield sync_spool
+    sync_spool.close()
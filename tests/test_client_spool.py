@@ -0,0 +1,122 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utilities import client
+from utilities import config
+
+
+class Listener(object):
+    """Stands in for the listener's bulk and single-item endpoints."""
+
+    def __init__(self):
+        self.up = True
+        self.codes = {}
+        self.received = []
+
+    def post_many(self, movies, batch_size=None, timeout=60, session=None):
+        movies = list(movies)
+        self.received.extend(m['path'] for m in movies)
+        if not self.up:
+            return []
+
+        return [{"index": index, "code": self.codes.get(m['path'], 200),
+                 "status": "ok"} for index, m in enumerate(movies)]
+
+    def post_one(self, path, imdb_guid=None, timeout=60, session=None):
+        self.received.append(path)
+        if not self.up:
+            return None
+
+        return SimpleNamespace(status_code=self.codes.get(path, 200),
+                               text="")
+
+
+@pytest.fixture
+def listener(monkeypatch, spool):
+    fake = Listener()
+    monkeypatch.setattr(client, "get_spool", lambda: spool)
+    monkeypatch.setattr(client, "post_new_movies_to_syncer", fake.post_many)
+    monkeypatch.setattr(client, "post_new_movie_to_syncer", fake.post_one)
+    monkeypatch.setattr(config, "CLIENT_SPOOL_RETRY_BASE_DELAY", 30)
+    monkeypatch.setattr(config, "CLIENT_SPOOL_RETRY_MAX_DELAY", 60)
+
+    return fake
+
+
+def _rows(spool):
+    return spool._connections.get().execute(
+        "SELECT * FROM sync_spool ORDER BY id").fetchall()
+
+
+def test_add_many_ignores_requests_already_spooled(spool):
+    assert len(spool.add_many([("tt1", "/a.mkv", None),
+                               (None, "/b.mkv", None)])) == 2
+    assert spool.add_many([("tt1", "/other.mkv", None),
+                           (None, "/b.mkv", None)]) == []
+    assert spool.count() == 2
+
+
+def test_flush_sends_and_removes_answered_requests(listener, spool):
+    client.spool_new_movies([{"guid": "tt1", "path": "/a.mkv"},
+                             {"path": "/b.mkv"}])
+
+    assert client.flush_spool() == (2, 0)
+    assert sorted(listener.received) == ["/a.mkv", "/b.mkv"]
+
+
+def test_flush_drops_requests_the_listener_rejects(listener, spool):
+    listener.codes["/a.mkv"] = 400
+    client.spool_new_movies([{"guid": "tt1", "path": "/a.mkv"}])
+
+    assert client.flush_spool() == (1, 0)
+
+
+def test_unanswered_requests_back_off_and_stay_spooled(listener, spool):
+    listener.up = False
+    client.spool_new_movies([{"guid": "tt1", "path": "/a.mkv"},
+                             {"path": "/b.mkv"}])
+
+    assert client.flush_spool() == (0, 2)
+
+    # The path-only request is not sent once the listener is known down
+    assert listener.received == ["/a.mkv"]
+    for row in _rows(spool):
+        assert row['attempts'] == 1
+        assert row['last_error'] == "listener unavailable"
+        assert row['next_attempt_at'] > time.time()
+
+    listener.up = True
+    assert client.flush_spool() == (0, 2)
+    assert client.flush_spool(force=True) == (2, 0)
+
+
+def test_drain_retries_until_the_spool_is_empty(listener, spool,
+                                                monkeypatch):
+    listener.up = False
+    client.spool_new_movies([{"guid": "tt1", "path": "/a.mkv"}])
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        # Bring the listener back and let the retry come due
+        listener.up = True
+        spool._connections.get().execute(
+            "UPDATE sync_spool SET next_attempt_at=0")
+
+    monkeypatch.setattr(client.time, "sleep", sleep)
+
+    assert client.drain_spool(deadline=600, timeout=1) == (1, 0)
+    assert len(sleeps) == 1
+    assert sleeps[0] > 1
+
+
+def test_drain_gives_up_at_the_deadline(listener, spool, monkeypatch):
+    listener.up = False
+    client.spool_new_movies([{"guid": "tt1", "path": "/a.mkv"}])
+    monkeypatch.setattr(client.time, "sleep", lambda seconds: None)
+
+    sent, remaining = client.drain_spool(deadline=0, timeout=1)
+
+    assert (sent, remaining) == (0, 1)
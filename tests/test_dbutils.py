@@ -0,0 +1,113 @@
+import time
+
+from utilities import dbutils
+
+
+def _insert(database, count):
+    guids = [f"tt{i:07d}" for i in range(1, count + 1)]
+    database.insert_many([(guid, f"/movies/{guid}.mkv", None, None)
+                          for guid in guids])
+
+    return guids
+
+
+def test_claim_leases_pending_rows_in_id_order(transfer_db):
+    guids = _insert(transfer_db, 3)
+
+    rows = transfer_db.claim("worker-a", limit=2, lease_seconds=60)
+
+    assert [row['guid'] for row in rows] == guids[:2]
+    for row in rows:
+        assert row['state'] == dbutils.QUEUED
+        assert row['lease_owner'] == "worker-a"
+        assert row['lease_expires'] > time.time()
+
+
+def test_claim_never_hands_out_a_leased_row_twice(transfer_db):
+    guids = _insert(transfer_db, 2)
+
+    first = transfer_db.claim("worker-a", limit=1)
+    second = transfer_db.claim("worker-b", limit=5)
+
+    assert [row['guid'] for row in first] == guids[:1]
+    assert [row['guid'] for row in second] == guids[1:]
+    assert transfer_db.claim("worker-c", limit=5) == []
+
+
+def test_claim_takes_over_expired_leases(transfer_db):
+    guid, = _insert(transfer_db, 1)
+    transfer_db.claim("worker-a", lease_seconds=-1)
+
+    rows = transfer_db.claim("worker-b")
+
+    assert [row['guid'] for row in rows] == [guid]
+    assert rows[0]['lease_owner'] == "worker-b"
+
+
+def test_claim_guids_returns_only_claimable_guids(transfer_db):
+    guids = _insert(transfer_db, 3)
+    transfer_db.claim_guids("worker-a", guids[:1])
+
+    claimed = transfer_db.claim_guids("worker-b", guids + ["tt9999999"])
+
+    assert claimed == guids[1:]
+
+
+def test_heartbeat_extends_only_own_leases(transfer_db):
+    guids = _insert(transfer_db, 2)
+    transfer_db.claim_guids("worker-a", guids[:1], lease_seconds=1)
+    transfer_db.claim_guids("worker-b", guids[1:], lease_seconds=1)
+
+    renewed = transfer_db.heartbeat("worker-a", guids, lease_seconds=600)
+
+    assert renewed == 1
+    assert transfer_db.select_guid(guids[0])['lease_expires'] > \
+        time.time() + 500
+    assert transfer_db.select_guid(guids[1])['lease_expires'] < \
+        time.time() + 2
+
+
+def test_release_returns_leased_rows_to_pending(transfer_db):
+    guids = _insert(transfer_db, 2)
+    transfer_db.claim("worker-a", limit=2)
+
+    released = transfer_db.release("worker-a")
+
+    assert sorted(released) == guids
+    for guid in guids:
+        row = transfer_db.select_guid(guid)
+        assert row['state'] == dbutils.PENDING
+        assert row['lease_owner'] is None
+
+
+def test_schedule_retry_backs_off_then_fails(transfer_db):
+    guid, = _insert(transfer_db, 1)
+    transfer_db.claim("worker-a")
+
+    next_attempt_at = transfer_db.schedule_retry(
+        guid, max_attempts=2, base_delay=60, max_delay=600, error="boom")
+
+    row = transfer_db.select_guid(guid)
+    assert row['state'] == dbutils.PENDING
+    assert row['attempts'] == 1
+    assert row['last_error'] == "boom"
+    assert next_attempt_at > time.time()
+    # Not claimable again until the backoff has passed
+    assert transfer_db.claim("worker-a") == []
+
+    assert transfer_db.schedule_retry(guid, max_attempts=2) is None
+    assert transfer_db.select_guid(guid)['state'] == dbutils.FAILED
+
+
+def test_defer_does_not_count_an_attempt(transfer_db):
+    guids = _insert(transfer_db, 2)
+    transfer_db.claim("worker-a", limit=2)
+
+    transfer_db.defer(guids[:1], time.time() + 600)
+    transfer_db.defer(guids[1:], time.time() - 1)
+
+    deferred = transfer_db.select_guid(guids[0])
+    assert deferred['state'] == dbutils.PENDING
+    assert deferred['attempts'] == 0
+    assert [row['guid'] for row in transfer_db.claim("worker-b", limit=2)] \
+        == guids[1:]
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from utilities import config
+from utilities import server
+
+
+@pytest.fixture
+def client(monkeypatch, transfer_db):
+    monkeypatch.setattr(server, "db", transfer_db)
+    monkeypatch.setattr(config, "REMOTE_FILE_SERVER", "files.local")
+    monkeypatch.setattr(config, "REMOTE_FILE_SERVERS", [])
+
+    return server.app.test_client()
+
+
+def _ndjson(*items):
+    return "\n".join(item if isinstance(item, str) else json.dumps(item)
+                     for item in items)
+
+
+def test_bulk_ndjson_reports_a_code_per_item(client, transfer_db):
+    transfer_db.insert("tt0000004", "/movies/existing.mkv")
+    body = _ndjson(
+        {"guid": "tt0000001", "path": "/movies/one.mkv"},
+        {"guid": "tt0000001", "path": "/movies/one-again.mkv"},
+        "not json",
+        {"guid": "tt0000002"},
+        {"guid": "tt0000003", "path": "/movies/three.mkv",
+         "host": "elsewhere"},
+        {"guid": "tt0000004", "path": "/movies/existing.mkv"},
+        {"path": "/movies/no-guid.mkv"},
+    )
+
+    response = client.post(config.NEW_MOVIES_ENDPOINT, data=body,
+                           content_type="application/x-ndjson")
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [(item['index'], item['code']) for item in data['items']] == [
+        (0, 200), (1, 208), (2, 400), (3, 400), (4, 400), (5, 208), (6, 400)]
+    assert data['status'] == {"inserted": 1, "duplicates": 2, "invalid": 4}
+    assert transfer_db.select_guid("tt0000001")['remote_path'] == \
+        "/movies/one.mkv"
+
+
+def test_bulk_json_array_is_accepted(client, transfer_db):
+    response = client.post(
+        config.NEW_MOVIES_ENDPOINT,
+        json=[{"guid": "tt0000001", "path": "/movies/one.mkv",
+               "host": "files.local"}])
+
+    assert [item['code'] for item in response.get_json()['items']] == [200]
+    assert transfer_db.select_guid("tt0000001")['remote_host'] == \
+        "files.local"
+
+
+def test_bulk_rejects_a_json_body_that_is_not_a_list(client):
+    response = client.post(config.NEW_MOVIES_ENDPOINT, json={"guid": "x"})
+
+    assert response.status_code == 400
+
+
+def test_queue_status_etag_returns_304_until_it_changes(client, transfer_db):
+    transfer_db.insert("tt0000001", "/movies/one.mkv")
+
+    first = client.get(config.QUEUE_ENDPOINT)
+    etag = first.headers['ETag']
+    unchanged = client.get(config.QUEUE_ENDPOINT,
+                           headers={"If-None-Match": etag})
+    transfer_db.insert("tt0000002", "/movies/two.mkv")
+    changed = client.get(config.QUEUE_ENDPOINT,
+                         headers={"If-None-Match": etag})
+
+    assert first.status_code == 200
+    assert unchanged.status_code == 304
+    assert unchanged.data == b""
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_movie_status_etag(client, transfer_db):
+    transfer_db.insert("tt0000001", "/movies/one.mkv")
+    url = config.MOVIE_STATUS_ENDPOINT + "tt0000001"
+
+    etag = client.get(url).headers['ETag']
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code \
+        == 304
+    assert client.get(config.MOVIE_STATUS_ENDPOINT + "tt9999999") \
+        .status_code == 404
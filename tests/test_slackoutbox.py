@@ -0,0 +1,101 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utilities import slackoutbox
+
+
+@pytest.fixture
+def outbox(monkeypatch, transfer_db):
+    responses = []
+
+    def post(sender, payload, timeout=None):
+        return responses.pop(0)
+
+    monkeypatch.setattr(slackoutbox.SlackSender, "post", post)
+    box = slackoutbox.SlackOutbox(transfer_db)
+    box.responses = responses
+
+    return box
+
+
+def _response(status_code, headers=None):
+    return SimpleNamespace(status_code=status_code, text="",
+                           headers=headers or {})
+
+
+def _claim_one(outbox):
+    outbox.db.enqueue_slack("https://hooks.example", '{"text": "hi"}')
+    row, = outbox.db.claim_slack()
+
+    return row
+
+
+def _stored(outbox):
+    return outbox.db._query("SELECT * FROM slack_outbox").fetchall()
+
+
+def test_429_pauses_for_retry_after_without_using_an_attempt(outbox):
+    row = _claim_one(outbox)
+    outbox.responses.append(_response(429, {"Retry-After": "120"}))
+
+    paused_until = outbox._deliver(row)
+
+    assert paused_until == pytest.approx(time.time() + 120, abs=5)
+    stored, = _stored(outbox)
+    assert stored['attempts'] == 0
+    assert stored['next_attempt_at'] == pytest.approx(paused_until, abs=1)
+
+
+def test_429_without_retry_after_backs_off(outbox):
+    row = _claim_one(outbox)
+    outbox.responses.append(_response(429))
+
+    paused_until = outbox._deliver(row)
+
+    assert paused_until > time.time()
+    assert _stored(outbox)[0]['attempts'] == 0
+
+
+def test_pause_postpones_the_rest_of_the_batch(outbox):
+    for _ in range(3):
+        outbox.db.enqueue_slack("https://hooks.example", "{}")
+    rows = outbox.db.claim_slack()
+    paused_until = time.time() + 300
+
+    outbox._pause(rows[1:], paused_until)
+
+    stored = _stored(outbox)
+    assert [r['next_attempt_at'] == pytest.approx(paused_until, abs=1)
+            for r in stored] == [False, True, True]
+    assert all(r['attempts'] == 0 for r in stored)
+
+
+def test_server_error_is_retried_and_counted(outbox):
+    row = _claim_one(outbox)
+    outbox.responses.append(_response(503))
+
+    assert outbox._deliver(row) is None
+
+    stored, = _stored(outbox)
+    assert stored['attempts'] == 1
+    assert stored['next_attempt_at'] > time.time()
+
+
+def test_client_error_drops_the_message(outbox):
+    row = _claim_one(outbox)
+    outbox.responses.append(_response(400))
+
+    outbox._deliver(row)
+
+    assert _stored(outbox) == []
+
+
+def test_success_deletes_the_message(outbox):
+    row = _claim_one(outbox)
+    outbox.responses.append(_response(200))
+
+    outbox._deliver(row)
+
+    assert _stored(outbox) == []
@@ -0,0 +1,14 @@
+import check_startup
+
+
+def test_startup_defers_heavy_imports_and_shared_objects():
+    heavy, created = check_startup.startup_state()
+
+    assert heavy == []
+    assert created == []
+
+
+def test_startup_import_time_within_budget():
+    best_us = min(check_startup.import_time_us()[0] for _ in range(3))
+
+    assert best_us / 1000 <= check_startup.BUDGET_MS